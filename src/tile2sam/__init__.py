@@ -0,0 +1,3 @@
+from .tile2sam import Conversion, Tile2SamError, convert
+
+__all__ = ['Conversion', 'Tile2SamError', 'convert']
@@ -4,17 +4,46 @@
 """Convert SAM Coupé graphics to Z80 code or data"""
 
 import argparse
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import mmap
 import operator
 import os
 import re
-import struct
+import socket
+import socketserver
 import sys
+import time
+import traceback
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from importlib.metadata import PackageNotFoundError, version
+from typing import NamedTuple
 
 from PIL import Image
+from PIL import __version__ as PIL_VERSION
 
 CLUT_SIZE = 16
 TRANSPARENT = CLUT_SIZE  # invalid clut index for transparent colour
+BASIC_CLUT = [0, 16, 32, 48, 64, 80, 96, 120, 0, 17, 34, 51, 68, 85, 102, 127]  # default SAM BASIC palette
+CACHE_MAX_SIZE = 64 * 1024 * 1024  # generated code cache limit in bytes
+CACHE_MEMORY_ENTRIES = 4096  # generated code kept in memory between conversions
+WATCH_INTERVAL = 0.2  # seconds between checks for changed inputs
+COLOUR_LUT_SIZE = 64 * 64 * 64  # RGB cells of 6 bits per channel
+PAGE_SIZE = 16 * 1024  # SAM memory page size in bytes
+IMAGE_CACHE_ENTRIES = 32  # palettised images kept in memory between conversions
+ORDER_SEARCH_BUDGET = 100000  # move cost evaluations per searched routine
+TIMING_MODELS = ['nominal', 'border', 'display']
+DATA_CHUNK_TILES = 256  # tiles packed to data at once
+WRITE_BUFFER_SIZE = 64 * 1024  # output file buffer size in bytes
 
 instr_timings = [
     # regex, bytes, tstates
@@ -47,10 +76,14 @@ instr_timings = [
 z80_routines = ['unmasked', 'masked', 'save', 'restore', 'copy', 'clear', 'rect']
 
 
+class Tile2SamError(Exception):
+    """Invalid option or image, reported by the command-line tool as an error"""
+
+
 def bpp_from_mode(m):
     """Return bits per pixel for given screen mode"""
     if m not in [1, 2, 3, 4]:
-        sys.exit(f"error: invalid screen mode ({m}), must be 1-4")
+        raise Tile2SamError(f"invalid screen mode ({m}), must be 1-4")
     return [1, 1, 2, 4][m - 1]
 
 
@@ -63,28 +96,83 @@ def rgb_from_index(i):
     return (red, green, blue)
 
 
+@functools.cache
 def generate_sam_palette():
     """Create a list of RGB values for the SAM palette of 128 colours"""
     palette = [rgb_from_index(i) for i in range(128)]
     return palette
 
 
-def palettise_image(img, palette, bkg_col=None):
-    """Map image to nearest colours in a given palette"""
-    img_palette = Image.new('P', img.size)
+@functools.lru_cache(maxsize=8)
+def palette_image(palette):
+    """Return an image holding a palette of RGB tuples, for use by quantize()"""
+    img_palette = Image.new('P', (1, 1))
     img_palette.putpalette([c for tup in palette for c in tup])
+    return img_palette
+
+
+@functools.cache
+def colour_lut(palette):
+    """Return a table of the nearest palette index for each RGB cell, as Pillow's quantize() would choose"""
+    # quantize() chooses colours using 6 bits per channel, so build the table
+    # from Pillow itself for the exact same results. It's saved to the cache
+    # directory and memory-mapped by later runs.
+    key = hashlib.sha256(repr([PIL_VERSION, palette]).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir(), f'colours-{key}.lut')
+
+    try:
+        with open(path, 'rb') as f:
+            lut = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(lut) == COLOUR_LUT_SIZE:
+            return lut
+    except (OSError, ValueError):
+        pass
+
+    cells = bytes(c << 2 for i in range(COLOUR_LUT_SIZE) for c in (i >> 12, (i >> 6) & 0x3f, i & 0x3f))
+    img_cells = Image.frombytes('RGB', (512, COLOUR_LUT_SIZE // 512), cells)
+    lut = img_cells.quantize(palette=palette_image(palette), dither=Image.Dither.NONE).tobytes()
+
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+            f.write(lut)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+    except OSError:
+        pass
+    return lut
+
 
+def map_colours(img, palette):
+    """Map image to nearest colours in a given palette, returning it with the alpha channel"""
     img_rgba = img.convert("RGBA")
-    img_pal = img_rgba.convert("RGB").quantize(palette=img_palette, dither=Image.Dither.NONE)
-    rgba_pixels = img_rgba.load()
-    pal_pixels = img_pal.load()
+    img_alpha = img_rgba.getchannel('A')
 
-    col_map = {}
-    for y in range(img.height):
-        for x in range(img.width):
-            col_map[pal_pixels[x, y]] = rgba_pixels[x, y]
+    if img.mode in ['P', 'L']:
+        # Map the source palette to the nearest colours, then all pixels in a single pass
+        lut = colour_lut(tuple(palette))
+        src_palette = img.getpalette('RGB') if img.mode == 'P' else [i for i in range(256) for _ in range(3)]
+        src_palette += [0] * (768 - len(src_palette))
+        index_map = bytes(lut[(r >> 2) << 12 | (g >> 2) << 6 | (b >> 2)] for r, g, b in group_split(src_palette, 3))
+
+        img_pal = Image.frombytes('P', img.size, img.tobytes().translate(index_map))
+        img_pal.putpalette([c for tup in palette for c in tup])
+    else:
+        img_pal = img_rgba.convert("RGB").quantize(palette=palette_image(tuple(palette)), dither=Image.Dither.NONE)
+
+    return img_pal, img_alpha
+
+
+def palettise_image(img, palette, bkg_col=None):
+    """Map image to nearest colours in a given palette"""
+    img_pal, img_alpha = map_colours(img, palette)
+
+    transp_cols = []
+    extrema = img_alpha.getextrema()  # None for an empty image
+    if extrema and extrema[0] == 0:
+        # Alpha of the last pixel using each palette index, mapped in bulk
+        alpha_map = dict(zip(img_pal.tobytes(), img_alpha.tobytes()))
+        transp_cols = sorted([i for i, a in alpha_map.items() if a == 0])  # zero alpha
 
-    transp_cols = sorted([i for i, c in col_map.items() if c[3] == 0])  # zero alpha
     bkg_cols = [bkg_col] if bkg_col is not None else transp_cols or [0]
 
     return bkg_cols, img_pal
@@ -99,7 +187,7 @@ def read_palette(pal):
         try:
             return [(int(x, 0) & 0x7f) for x in pal.split(',')]
         except ValueError:
-            sys.exit("error: invalid colour list")
+            raise Tile2SamError("invalid colour list")
 
 
 def clut_index(colour, clut, bkg_cols=[]):
@@ -113,37 +201,47 @@ def clutise_image(img, clut, bkg_cols=[]):
     return img.point(lambda i: col_map.get(i, TRANSPARENT))
 
 
+def crop_box(geometry):
+    """Return the crop box for a given geometry string"""
+    crop = [int(x) for x in re.findall(r"\d+", geometry)]
+    if len(crop) == 2:      # WxH
+        return (0, 0, *crop)
+    elif len(crop) == 4:    # WxH+X+Y
+        return (crop[2], crop[3], crop[2]+crop[0], crop[3]+crop[1])
+    raise Tile2SamError("invalid crop region (should be WxH or WxH+X+H)")
+
+
 def crop_image(img, geometry):
     """Clip image to given geometry string"""
+    return img.crop(crop_box(geometry))
+
+
+def scale_size(size, scale):
+    """Return an image size scaled by given factor(s)"""
     try:
-        crop = [int(x) for x in re.findall(r"\d+", geometry)]
-        if len(crop) == 2:      # WxH
-            img = img.crop((0, 0, *crop))
-        elif len(crop) == 4:    # WxH+X+Y
-            img = img.crop((crop[2], crop[3], crop[2]+crop[0], crop[3]+crop[1]))
-        else:
-            raise ValueError
-        return img
+        factors = [float(x) for x in re.findall(r"[\d.]+", scale)] * 2
+        new_size = [int(n * factors[i]) for i, n in enumerate(size)]
+        if min(new_size) <= 0:
+            raise ValueError("empty scaled image")
+        return new_size
     except (ValueError, IndexError):
-        sys.exit("error: invalid crop region (should be WxH or WxH+X+H)")
+        raise Tile2SamError("invalid scale factors")
 
 
 def scale_image(img, scale):
     """Scale image by given factor(s)"""
-    try:
-        factors = [float(x) for x in re.findall(r"[\d.]+", scale)] * 2
-        return img.resize([int(n * factors[i]) for i, n in enumerate(img.size)], Image.Resampling.NEAREST)
-    except (ValueError, IndexError):
-        sys.exit("error: invalid scale factors")
+    return img.resize(scale_size(img.size, scale), Image.Resampling.NEAREST)
 
 
 def get_tile_size(size):
     """Return width and height given a 1D or 2D size"""
     try:
         dimensions = [int(x, 0) for x in re.findall(r"\d+", size)] * 2
+        if len(dimensions) < 2 or min(dimensions) <= 0:
+            raise ValueError("tile size should have positive dimensions")
         return dimensions[:2]
     except (ValueError, IndexError):
-        sys.exit("error: invalid tile dimensions")
+        raise Tile2SamError("invalid tile dimensions")
 
 
 def get_tile_selection(tile_select, max_tiles):
@@ -161,7 +259,7 @@ def get_tile_selection(tile_select, max_tiles):
             ranges = [[int(x, 0) for x in r.split('-')] for r in range_items]
             selection = [x * 2 if len(x) == 1 else x[:2] for x in ranges]
         except (ValueError, IndexError):
-            sys.exit("error: invalid tile count or range")
+            raise Tile2SamError("invalid tile count or range")
     return selection
 
 
@@ -194,30 +292,57 @@ def rect_mask(mask_data):
 # Code Generation Helpers
 
 
+class Instr(NamedTuple):
+    """Z80 instruction or label, with its size and timing"""
+    opcode: str
+    operands: str
+    size: int | None
+    tstates: int | None
+
+    def __str__(self):
+        return f'{self.opcode} {self.operands}' if self.operands else self.opcode
+
+
+@functools.cache
+def parse_instr(line):
+    """Parse a line of code, looking up its size and timing only once"""
+    line = line.strip()
+    opcode, _, operands = line.partition(' ')
+    timing = None, None
+    for regex, size, tstates in instr_timings:
+        profile_counts['regex evaluations'] += 1
+        if re.fullmatch(regex, line):
+            timing = size, tstates
+            break
+    return Instr(opcode, operands, *timing)
+
+
+def parse_code(lines):
+    """Parse a list of code lines to instructions"""
+    return [parse_instr(line) for line in lines]
+
+
 def code_size(instrs):
     """Return the size of a list of instructions in bytes"""
-    instrs = [instr.strip() for instr in instrs]
-    return sum([next(size
-               for regex, size, _ in instr_timings if re.fullmatch(regex, instr))
-                for instr in instrs])
+    return sum(instr.size for instr in instrs)
+
 
+def nominal_timing(instrs, model='nominal'):
+    """Return the timing of a list of instructions in t-states, nominal or with memory contention"""
+    if model != 'nominal':
+        cycles = itertools.chain.from_iterable(lookup_cycles(instr)[0] for instr in instrs)
+        return contended_timing(cycles, 0, CONTENTION_SLOTS[model])
 
-def nominal_timing(instrs):
-    """Return the nominal timing of a list of instructions in t-states"""
-    instrs = [instr.strip() for instr in instrs]
-    unknown = [instr for instr in instrs if not [regex for regex, _, _ in instr_timings if re.fullmatch(regex, instr)]]
+    unknown = [str(instr) for instr in instrs if instr.tstates is None]
     if unknown:
-        sys.exit(f'error: no timings for instruction(s): {unknown}')
-    # debug = { instr:[tstates for regex,size,tstates in instr_timings if re.fullmatch(regex, instr)][0] for instr in instrs }
+        raise Tile2SamError(f'no timings for instruction(s): {unknown}')
 
-    return sum([next(tstates
-               for regex, _, tstates in instr_timings if re.fullmatch(regex, instr))
-                for instr in instrs])
+    return sum(instr.tstates for instr in instrs)
 
 
-def fastest_code(*code):
-    """Return the code blocks with the lowest nominal timing"""
-    return min(*code, key=lambda x: sum(nominal_timing(z) for z in x))
+def fastest_code(*code, model='nominal'):
+    """Return the code blocks with the lowest timing, using the given timing model"""
+    return min(*code, key=lambda x: sum(nominal_timing(z, model) for z in x))
 
 
 def branched_code(label, coord_code, code0, code1, shifted):
@@ -226,37 +351,36 @@ def branched_code(label, coord_code, code0, code1, shifted):
         coord_code = []
 
     if not shifted or code0 == code1:
-        return ('', f'{label}:', *coord_code, *code0)
+        return [*parse_code(['', f'{label}:']), *coord_code, *code0]
 
     end_regex = r'^(ret|and|or|xor|sub|sbc|add|adc|ld\s+\(.*?\),sp)'
     common = []
     for a, b in zip(code0, code1):
-        if a != b or re.match(end_regex, a):
+        if a != b or re.match(end_regex, str(a)):
             break
         common.append(a)
 
     code0, code1 = code0[len(common):], code1[len(common):]
-    code = ['', f'{label}:', *coord_code, *common]
+    code = [*parse_code(['', f'{label}:']), *coord_code, *common]
 
     if len(code0) == 1:
-        code += ['ret nc', *code1]
+        code += [parse_instr('ret nc'), *code1]
     elif len(code1) == 1:
-        code += ['ret c', *code0]
+        code += [parse_instr('ret c'), *code0]
     else:
-        code += [f'jr c,{label}_1' if code_size(code0) < 128 else f'jp c,{label}_1']
-        code += [f'{label}_0:', *code0, f'{label}_1:', *code1]
+        code += [parse_instr(f'jr c,{label}_1' if code_size(code0) < 128 else f'jp c,{label}_1')]
+        code += [parse_instr(f'{label}_0:'), *code0, parse_instr(f'{label}_1:'), *code1]
     return code
 
 
 def format_code(code):
     """Format code for output, aligning instructions and operands"""
     text = ''
-    for line in code:
-        fields = line.split(' ', 1)
-        if line == '' or fields[0].endswith(':'):
-            text += f'{line}\n'
+    for instr in code:
+        if instr.opcode == '' or instr.opcode.endswith(':'):
+            text += f'{instr}\n'
         else:
-            text += f"{' ' * 8}{fields[0]}{' ' * (5 - len(fields[0]))}{''.join(fields[1:])}\n"
+            text += f"{' ' * 8}{instr.opcode}{' ' * (5 - len(instr.opcode))}{instr.operands}\n"
     return text
 
 
@@ -282,10 +406,11 @@ class ValueStream:
         return rr if rr in free else None
 
     def get_cacheable(self, data):
-        mru = []
+        mru = collections.OrderedDict()
         count = {}
         first = {}
         last = {}
+        num_candidates = 0  # values in mru seen at least twice
         cacheable = []
 
         for i, b in enumerate(data):
@@ -293,25 +418,23 @@ class ValueStream:
             first[b] = first.get(b, i)
             last[b] = i
 
-            if b in mru:
-                mru.remove(b)
-            mru.append(b)
-
-            candidates = [x for x in mru if count[x] >= 2]
+            if count[b] == 2:
+                num_candidates += 1
 
-            if len(candidates) >= len(self.regs):
-                b0 = candidates[0]
-                idx = mru.index(b0)
+            mru[b] = None
+            mru.move_to_end(b)
 
-                if len(candidates) > len(self.regs):
-                    if count[b0] >= 2:
-                        cacheable.append((b0, first[b0], last[b0]))
-                    idx += 1
+            if num_candidates >= len(self.regs):
+                # Drop values seen only once that are older than the first candidate
+                while count[next(iter(mru))] < 2:
+                    x, _ = mru.popitem(last=False)
+                    del count[x], first[x]
 
-                for i in range(idx):
-                    del count[mru[i]]
-                    del first[mru[i]]
-                mru = mru[idx:]
+                if num_candidates > len(self.regs):
+                    b0, _ = mru.popitem(last=False)
+                    cacheable.append((b0, first[b0], last[b0]))
+                    del count[b0], first[b0]
+                    num_candidates -= 1
 
         cacheable += [(x, first[x], last[x]) for x in mru if count[x] >= 2]
         return cacheable
@@ -321,12 +444,19 @@ class ValueStream:
         changes = {}
         cache = {}
 
-        cacheable = self.get_cacheable(data)
+        # Cacheable values in order of first use, each dropped after its last use
+        cacheable = sorted(self.get_cacheable(data), key=lambda x: x[1])
+        scoped = collections.OrderedDict.fromkeys(range(len(cacheable)))
+        expired = [[] for _ in range(len(data) + 1)]
+        for k, (_, _, last) in enumerate(cacheable):
+            expired[last + 1].append(k)
 
         for i, b in enumerate(data):
+            for k in expired[i]:
+                del scoped[k]
+
             if b not in cache:
-                scoped = [(val, first - i) for val, first, last in cacheable if i <= last]
-                pending = [x[0] for x in sorted(scoped, key=lambda kv: kv[1])][:len(self.regs)]
+                pending = [cacheable[k][0] for k in itertools.islice(scoped, len(self.regs))]
 
                 if data[i] in pending:
                     cache = {k: v for k, v in cache.items() if k in pending}
@@ -354,6 +484,135 @@ class ValueStream:
         return values, changes
 
 
+class OptimalValueStream(ValueStream):
+    """Value stream with register loads chosen using knowledge of all values
+
+    Holding a value in a register saves 4T on each use, and loading it costs
+    8T. Choosing which values to hold, and for how long, is solved as a
+    min-cost flow with one unit of flow per register. The flow can't see that
+    loading both registers of a pair costs only 12T, so pair loads are just
+    combined afterwards where the pair is free, and the result is sometimes
+    slower than ValueStream."""
+
+    LOAD_COST = 8   # ld r,n
+    USE_SAVING = 4  # register operand instead of immediate
+
+    def spare_pair(self):
+        free = ''.join([r for r in 'bcde' if r not in self.values[self.index:]])
+        rr = 'bc' if 'bc' in free else 'de'
+        return rr if rr in free else None
+
+    def get_intervals(self, data):
+        """Return the (first, last) positions held in each register"""
+        n = len(data)
+        num_nodes = 2 * n + 1  # chain nodes 0..n, then a use node for each position
+        edges_to, edges_cap, edges_cost = [], [], []
+        graph = [[] for _ in range(num_nodes)]
+
+        def add_edge(u, v, cap, cost):
+            graph[u].append(len(edges_to))
+            edges_to.append(v)
+            edges_cap.append(cap)
+            edges_cost.append(cost)
+            graph[v].append(len(edges_to))
+            edges_to.append(u)
+            edges_cap.append(0)
+            edges_cost.append(-cost)
+
+        next_use, seen = [-1] * n, {}  # position of the next use of each value, if any
+        for i in reversed(range(n)):
+            next_use[i], seen[data[i]] = seen.get(data[i], -1), i
+
+        for i in range(n):
+            add_edge(i, i + 1, len(self.regs), 0)  # register not in use
+            add_edge(n + 1 + i, i + 1, 1, 0)  # release after use
+            if next_use[i] >= 0:
+                add_edge(i, n + 1 + i, 1, self.LOAD_COST - self.USE_SAVING)  # load for this use
+                add_edge(n + 1 + i, n + 1 + next_use[i], 1, -self.USE_SAVING)  # hold for next use
+
+        # Initial potentials from the DAG, visiting nodes in position order
+        potential = [0] + [math.inf] * (num_nodes - 1)
+        for u in itertools.chain.from_iterable((i, n + 1 + i) for i in range(n)):
+            for e in graph[u]:
+                if edges_cap[e] and potential[u] + edges_cost[e] < potential[edges_to[e]]:
+                    potential[edges_to[e]] = potential[u] + edges_cost[e]
+
+        # Successive shortest paths, one register at a time
+        for _ in self.regs:
+            dist = [math.inf] * num_nodes
+            via = [-1] * num_nodes  # edge used to reach each node
+            dist[0] = 0
+            heap = [(0, 0)]
+            while heap:
+                d, u = heapq.heappop(heap)
+                if d > dist[u]:
+                    continue
+                for e in graph[u]:
+                    v = edges_to[e]
+                    nd = d + edges_cost[e] + potential[u] - potential[v]
+                    if edges_cap[e] and nd < dist[v]:
+                        dist[v], via[v] = nd, e
+                        heapq.heappush(heap, (nd, v))
+
+            potential = [p + d if d < math.inf else p for p, d in zip(potential, dist)]
+            v = n
+            while v:
+                e = via[v]
+                edges_cap[e] -= 1
+                edges_cap[e ^ 1] += 1
+                v = edges_to[e ^ 1]
+
+        # Follow each unit of flow to find the (first, last) uses held by that register
+        intervals = []
+        for _ in self.regs:
+            held, u = [], 0
+            while u != n:
+                # Prefer loads, so any unused registers are left at the end
+                e = max((e for e in graph[u] if e % 2 == 0 and edges_cap[e ^ 1]), key=lambda e: edges_to[e])
+                edges_cap[e ^ 1] -= 1
+                if edges_to[e] > n and u <= n:
+                    held.append([edges_to[e] - n - 1] * 2)
+                elif edges_to[e] > n:
+                    held[-1][1] = edges_to[e] - n - 1
+                u = edges_to[e]
+            intervals.append(held)
+
+        return sorted(intervals, key=len, reverse=True)
+
+    def get_values(self, data):
+        values = [f'&{b:02x}' for b in data]
+        intervals = dict(zip(self.regs, self.get_intervals(data)))
+        loads = {}
+
+        for r, held in intervals.items():
+            for first, last in held:
+                loads[first] = (r, data[first])
+                for i in range(first, last + 1):
+                    if data[i] == data[first]:
+                        values[i] = r
+
+        # Combine loads into both halves of a register pair, if the second
+        # register is free at the time of the first load
+        for rr in [x for x in ['bc', 'de'] if x in self.regs]:
+            held0, held1 = intervals[rr[0]], intervals[rr[1]]
+            i0 = i1 = 0
+            while i0 < len(held0) and i1 < len(held1):
+                (first0, _), (first1, _) = held0[i0], held1[i1]
+                if first0 < first1 and (i1 == 0 or held1[i1 - 1][1] < first0):
+                    loads[first0] = (rr, data[first0], loads.pop(first1)[1])
+                    i0, i1 = i0 + 1, i1 + 1
+                elif first1 < first0 and (i0 == 0 or held0[i0 - 1][1] < first1):
+                    loads[first1] = (rr, loads.pop(first0)[1], data[first1])
+                    i0, i1 = i0 + 1, i1 + 1
+                elif first0 < first1:
+                    i0 += 1
+                else:
+                    i1 += 1
+
+        changes = {i: [f"ld {r},&{''.join(f'{x:02x}' for x in vals)}"] for i, (r, *vals) in loads.items()}
+        return values, changes
+
+
 def reg8_delta(a, b):
     """Determine 8-bit difference, allowing wrap-around"""
     delta = b - a if b > a else 256 + b - a
@@ -427,39 +686,133 @@ def reg16_change(a, b, *, reg='hl', spare_pair=None, value_stream=None):
 # Routine Generators
 
 
-def generate_draw_poke(image_data, mask_data, *, masked=True):
+def zigzag_addrs(mask_data):
+    """Return addresses of the bytes to visit, even lines down and odd lines up, in zig-zag pattern"""
+    addrs = []
+    dx = 1
+    width_bytes, height = len(mask_data[0]), len(mask_data)
+
+    for p in range(2):
+        for y in range(0, height, 2) if p == 0 else reversed(range(1, height, 2)):
+            for x in range(width_bytes) if dx > 0 else reversed(range(width_bytes)):
+                if mask_data[y][x]:
+                    addrs.append(y * 128 + x)
+            dx = -dx
+
+    return addrs
+
+
+def move_cost(a, b, *, spare_pair=None):
+    """Return the nominal timing to change HL from address a to b"""
+    return move_delta_cost(a & 0xff, b - a, spare_pair)
+
+
+@functools.cache
+def move_delta_cost(low, delta, spare_pair):
+    """Return the nominal timing to change HL by delta, from an address with the given low byte"""
+    a = 0x4000 | low  # only the low byte and distance affect the code
+    return nominal_timing(parse_code(reg16_change(a, a + delta, spare_pair=spare_pair)[0]))
+
+
+def path_cost(addrs, cost):
+    """Return the total cost of visiting addresses in order, from 0"""
+    return sum(map(cost, [0, *addrs], addrs))
+
+
+def greedy_addrs(addrs, cost, *, window=8):
+    """Order addresses by repeatedly moving to the cheapest nearby address"""
+    remaining = sorted(addrs)
+    order = []
+    last = 0
+
+    while remaining:
+        # Consider addresses near the current one, and near it on nearby lines
+        nearby = set()
+        for target in [last, last - 256, last - 128, last + 128, last + 256]:
+            pos = bisect.bisect_left(remaining, target)
+            nearby.update(remaining[max(0, pos - window):pos + window])
+
+        last = min(nearby, key=lambda a: (cost(last, a), a))
+        del remaining[bisect.bisect_left(remaining, last)]
+        order.append(last)
+
+    return order
+
+
+def improve_addrs(addrs, cost, *, budget, window=8):
+    """Improve an address order by moving single addresses to cheaper nearby positions"""
+    order = list(addrs)
+    evals = 0
+    improved = True
+
+    while improved and evals < budget:
+        improved = False
+        for i in range(len(order)):
+            addr = order[i]
+            prev = order[i - 1] if i else 0
+            following = order[i + 1] if i + 1 < len(order) else None
+            gain = cost(prev, addr) + (cost(addr, following) - cost(prev, following) if following is not None else 0)
+
+            for j in range(max(0, i - window), min(len(order), i + window + 1) + 1):
+                if j in (i, i + 1):
+                    continue
+
+                # Insert between order[j-1] and order[j]
+                p = order[j - 1] if j else 0
+                q = order[j] if j < len(order) else None
+                evals += 1
+
+                if cost(p, addr) + (cost(addr, q) - cost(p, q) if q is not None else 0) < gain:
+                    del order[i]
+                    order.insert(j if j < i else j - 1, addr)
+                    improved = True
+                    break
+
+            if evals >= budget:
+                break
+
+    return order
+
+
+def search_addrs(addrs, cost, *, budget=ORDER_SEARCH_BUDGET):
+    """Reorder addresses to reduce the total cost of moving between them, from 0
+
+    Both the original order and a greedy walk are improved locally, sharing a
+    budget of cost evaluations rather than time so the output is reproducible.
+    The cheaper result is returned, which is never worse than the original."""
+    orders = [improve_addrs(x, cost, budget=budget // 2) for x in [addrs, greedy_addrs(addrs, cost)]]
+    return min(orders, key=lambda x: path_cost(x, cost))
+
+
+def generate_draw_poke(image_data, mask_data, *, masked=True, optimal=False, search=False):
     """Generate drawing code that pokes data into memory"""
     spare_pair = None
+    image_addrs = zigzag_addrs(mask_data)
+    if search:
+        image_addrs = search_addrs(image_addrs, move_cost)
 
     # 2 outer passes to determine if a register pair is spare
     for _ in range(2):
-        image_addrs = []
-        mask_addrs = []
+        mask_addrs = set()
         values = []
         last_addr = 0
-        dx = 1
-        width_bytes, height = len(mask_data[0]), len(mask_data)
 
-        # Even lines down, odd lines up, in zig-zag pattern
-        for p in range(2):
-            for y in range(0, height, 2) if p == 0 else reversed(range(1, height, 2)):
-                for x in range(width_bytes) if dx > 0 else reversed(range(width_bytes)):
-                    if mask_data[y][x]:
-                        addr = y * 128 + x
-                        values += reg16_change(last_addr, addr, spare_pair=spare_pair)[1]
+        for addr in image_addrs:
+            y, x = divmod(addr, 128)
+            values += reg16_change(last_addr, addr, spare_pair=spare_pair)[1]
 
-                        if masked and mask_data[y][x] != 0xff:
-                            values.append(~mask_data[y][x] & 0xff)
-                            mask_addrs.append(addr)
+            if masked and mask_data[y][x] != 0xff:
+                values.append(~mask_data[y][x] & 0xff)
+                mask_addrs.add(addr)
 
-                        values.append(image_data[y][x] if image_data else 0)
-                        image_addrs.append(addr)
+            values.append(image_data[y][x] if image_data else 0)
+            last_addr = addr
 
-                        last_addr = addr
-
-                dx = -dx
-
-        stream = ValueStream(values, regs='bcde')
+        if optimal:
+            # Keep the spare pair free for address changes found by the first pass
+            stream = OptimalValueStream(values, regs=''.join(r for r in 'bcde' if r not in (spare_pair or '')))
+        else:
+            stream = ValueStream(values, regs='bcde')
         spare_pair = stream.spare_pair()
 
     code = []
@@ -484,7 +837,88 @@ def generate_draw_poke(image_data, mask_data, *, masked=True):
         last_addr = addr
 
     code.append('ret')
-    return code
+    return parse_code(code)
+
+
+def push_word_code(word, pairs, upcoming):
+    """Return code to push a data word, loading it into the least needed value pair"""
+    held = next((r for r, val in pairs.items() if val == word), None)
+    if held:
+        return [f'push {held}']
+
+    def load_code(reg):
+        val = pairs[reg]
+        if val is not None and val >> 8 == word >> 8:
+            return [f'ld {reg[1]},&{word & 0xff:02x}']
+        elif val is not None and val & 0xff == word & 0xff:
+            return [f'ld {reg[0]},&{word >> 8:02x}']
+        return [f'ld {reg},&{word:04x}']
+
+    # Prefer single byte loads, and keep values still needed by the rest of the row
+    reg = min(pairs, key=lambda r: (pairs[r] in upcoming, load_code(r)[0].startswith(f'ld {r},')))
+    code = load_code(reg)
+    pairs[reg] = word
+    return code + [f'push {reg}']
+
+
+def generate_draw_push(image_data, mask_data, *, model='nominal'):
+    """Generate unmasked drawing code that pushes runs of data, or pokes rows where faster"""
+    height = len(mask_data)
+    pairs = {'bc': None, 'de': None}
+    last_addr = 0
+
+    def poke_value(val, pairs):
+        """Register already holding a value, or the value itself"""
+        held = [r for pair, word in pairs.items() if word is not None
+                for r, v in zip(pair, [word >> 8, word & 0xff]) if v == val]
+        return held[0] if held else f'&{val:02x}'
+
+    code = ['ld (@+sp_restore+1),sp']
+    for p in range(2):
+        for y in range(0, height, 2) if p == 0 else reversed(range(1, height, 2)):
+            runs = []
+            for x, m in enumerate(mask_data[y]):
+                if m and runs and runs[-1][1] == x:
+                    runs[-1][1] = x + 1
+                elif m:
+                    runs.append([x, x + 1])
+            if not runs:
+                continue
+
+            # Poke each byte, using values already held in registers
+            poke_code, addr = [], last_addr
+            for start, end in runs:
+                for x in range(start, end):
+                    poke_code += reg16_change(addr, y * 128 + x)[0]
+                    poke_code.append(f'ld (hl),{poke_value(image_data[y][x], pairs)}')
+                    addr = y * 128 + x
+            poke_addr = addr
+
+            # Push each run of bytes from its end, poking any odd byte at the end
+            push_code, addr, push_pairs = [], last_addr, dict(pairs)
+            for start, end in runs:
+                odd = (end - start) & 1
+                push_code += reg16_change(addr, y * 128 + end - odd)[0]
+                addr = y * 128 + end - odd
+
+                if odd:
+                    push_code.append(f'ld (hl),{poke_value(image_data[y][end - 1], push_pairs)}')
+                if end - start > 1:
+                    words = [image_data[y][x + 1] << 8 | image_data[y][x] for x in range(end - odd - 2, start - 1, -2)]
+                    push_code.append('ld sp,hl')
+                    for i, word in enumerate(words):
+                        push_code += push_word_code(word, push_pairs, words[i + 1:])
+
+            poke_instrs, push_instrs = parse_code(poke_code), parse_code(push_code)
+            if fastest_code([poke_instrs], [push_instrs], model=model)[0] is poke_instrs:
+                code += poke_code
+                last_addr = poke_addr
+            else:
+                code += push_code
+                last_addr, pairs = addr, push_pairs
+
+    code += ['@sp_restore:', 'ld sp,0', 'ret']
+    return parse_code(code)
 
 
 def generate_save_restore_ldi(mask_data):
@@ -517,26 +951,17 @@ def generate_save_restore_ldi(mask_data):
         restore_code.insert(0, 'ex de,hl')
     restore_code.append('ret')
 
-    return save_code, restore_code, len(image_addrs)
+    return parse_code(save_code), parse_code(restore_code), len(image_addrs)
 
 
-def generate_save_restore_stack(mask_data):
+def generate_save_restore_stack(mask_data, *, search=False):
     """Generate save/restore code that uses both memory access and stack"""
-    mask_addrs = []
-    stack_space = 0
-    dx = 1
-    width_bytes, height = len(mask_data[0]), len(mask_data)
-
-    # Even lines down, odd lines up, in zig-zag pattern
-    for p in range(2):
-        for y in range(0, height, 2) if p == 0 else reversed(range(1, height, 2)):
-            for x in range(width_bytes) if dx > 0 else reversed(range(width_bytes)):
-                if mask_data[y][x]:
-                    addr = y * 128 + x
-                    mask_addrs.append(addr)
-                    stack_space += 1
+    mask_addrs = zigzag_addrs(mask_data)
+    stack_space = len(mask_addrs)
 
-            dx = -dx
+    if search:
+        # Restore visits the same addresses in reverse, so count both directions
+        mask_addrs = search_addrs(mask_addrs, lambda a, b: move_cost(a, b, spare_pair='bc') + move_cost(b, a, spare_pair='bc'))
 
     last_addr = 0
     first_byte = True
@@ -579,47 +1004,45 @@ def generate_save_restore_stack(mask_data):
 
     restore_code += ['@sp_restore:', 'ld sp,0', 'ret']
 
-    return save_code, restore_code, save_size
+    return parse_code(save_code), parse_code(restore_code), save_size
 
 
-def generate_restore_copy(mask_data, *, low=False):
+def copy_move_cost(a, b):
+    """Return the nominal timing to move both copy pointers on from a to b"""
+    dir = -1 if (b & 0x7f) < (a & 0x7f) else 1
+    cost = move_cost(a + dir, b, spare_pair='bc')
+    return cost + min(cost, 16)  # DE follows HL, or is synced from it
+
+
+def generate_restore_copy(mask_data, *, low=False, search=False):
     """Generate restore by copying from screen in other 32K"""
-    image_addrs, next_dir = [], []
-    width_bytes, height = len(mask_data[0]), len(mask_data)
-    dx = 1
+    image_addrs = zigzag_addrs(mask_data)
+    if search:
+        image_addrs = search_addrs(image_addrs, copy_move_cost)
 
-    # Even lines down, odd lines up, in zig-zag pattern
-    for p in range(2):
-        for y in range(0, height, 2) if p == 0 else reversed(range(1, height, 2)):
-            for x in range(width_bytes) if dx > 0 else reversed(range(width_bytes)):
-                if mask_data[y][x]:
-                    addr = y * 128 + x
-                    image_addrs.append(addr)
-                    if len(image_addrs) > 1:
-                        next_dir.append(-1 if (image_addrs[-1] & 0x7f) < (image_addrs[-2] & 0x7f) else 1)
-            dx = -dx
+    next_dir = [-1 if (b & 0x7f) < (a & 0x7f) else 1 for a, b in zip(image_addrs, image_addrs[1:])]
     next_dir.append(next_dir[-1] if next_dir else 1)  # duplicate final direction, if any
 
     addr_flip = 1 << 15
     last_src, last_dst = None, 0
 
     restore_code = []
-    sync_de_code = ['ld d,h', 'ld e,l', 'res 7,d' if low else 'set 7,d',]
+    sync_de_code = parse_code(['ld d,h', 'ld e,l', 'res 7,d' if low else 'set 7,d',])
 
     for addr, dir in zip(image_addrs, next_dir):
-        restore_code += reg16_change(last_dst, addr, reg='hl', spare_pair='bc')[0]
+        restore_code += parse_code(reg16_change(last_dst, addr, reg='hl', spare_pair='bc')[0])
 
         if last_src is None:
             restore_code += sync_de_code
         else:
-            change_de_code = reg16_change(last_src, addr ^ addr_flip, reg='de', spare_pair='bc')[0]
+            change_de_code = parse_code(reg16_change(last_src, addr ^ addr_flip, reg='de', spare_pair='bc')[0])
             restore_code += sync_de_code if nominal_timing(change_de_code) > nominal_timing(sync_de_code) else change_de_code
 
-        restore_code.append('ldi' if dir > 0 else 'ldd')
+        restore_code.append(parse_instr('ldi' if dir > 0 else 'ldd'))
         last_dst = addr + dir
         last_src = last_dst ^ addr_flip
 
-    restore_code.append('ret')
+    restore_code.append(parse_instr('ret'))
 
     return restore_code
 
@@ -653,7 +1076,7 @@ def generate_clear_push(mask_data):
             code += ['push de'] * (fill_len // 2)
 
     code += ['@sp_restore:', 'ld sp,0', 'ret']
-    return code
+    return parse_code(code)
 
 
 def generate_clear_rect_push(width_bytes, height):
@@ -680,135 +1103,846 @@ def generate_clear_rect_push(width_bytes, height):
             code += ['push de'] * (width_bytes // 2)
 
     code += ['@sp_restore:', 'ld sp,0', 'ret']
-    return code
+    return parse_code(code)
+
+###############################################################################
+# Z80 Execution
+
+
+CONTENTION_SLOTS = {'none': 1, 'border': 4, 'display': 8}  # t-states between memory access slots
+
+instr_cycles = [
+    # regex, (access, internal) t-states for each machine cycle, and if a branch is taken
+    (r'ld\s+\w,\(hl\)', ((4, 0), (3, 0))),                            # ld r,(hl)
+    (r'ld\s+\(hl\),[bcdehla]', ((4, 0), (3, 0))),                     # ld (hl),r
+    (r'ld\s+\(hl\),.*', ((4, 0), (3, 0), (3, 0))),                    # ld (hl),n
+    (r'ld\s+[bcdehla],[bcdehla]', ((4, 0),)),                         # ld r,r
+    (r'ld\s+\w,[^(]+', ((4, 0), (3, 0))),                             # ld r,n
+    (r'ld\s+sp,hl', ((4, 2),)),                                       # ld sp,hl
+    (r'ld\s+\w\w,[^(]+', ((4, 0), (3, 0), (3, 0))),                   # ld rr,n
+    (r'ld\s+\(.*?\),hl', ((4, 0), (3, 0), (3, 0), (3, 0), (3, 0))),            # ld (nn),hl
+    (r'ld\s+\(.*?\),(bc|de|sp)', ((4, 0), (4, 0), (3, 0), (3, 0), (3, 0), (3, 0))),  # ld (nn),rr
+    (r'add\s+hl,\w\w', ((4, 7),)),                                    # add hl,rr
+    (r'(add|adc|sbc)\s+a,[bcdehla]', ((4, 0),)),                      # add|adc|sbc a,r
+    (r'(add|adc|sbc)\s+a,.*', ((4, 0), (3, 0))),                      # add|adc|sbc a,n
+    (r'(inc|dec|and|or|xor|sub)\s+[bcdehla]', ((4, 0),)),             # inc|dec|and|or|xor|sub r
+    (r'(and|or|xor|sub)\s+.*', ((4, 0), (3, 0))),                     # and|or|xor|sub n
+    (r'(inc|dec)\s+\w\w', ((4, 2),)),                                 # inc|dec rr
+    (r'(set|res)\s+\d,\w', ((4, 0), (4, 0))),                         # res|set b,r
+    (r'(srl|rr)\s+\w', ((4, 0), (4, 0))),                             # srl|rr r
+    (r'(ldi|ldd)', ((4, 0), (4, 0), (3, 0), (3, 2))),
+    (r'pop\s+\w\w', ((4, 0), (3, 0), (3, 0))),
+    (r'push\s+\w\w', ((4, 1), (3, 0), (3, 0))),
+    (r'ex de,hl', ((4, 0),)),
+    (r'scf', ((4, 0),)),
+    (r'ret', ((4, 0), (3, 0), (3, 0))),
+    (r'ret\s+n?c', ((4, 1),), ((4, 1), (3, 0), (3, 0))),              # ret cc
+    (r'jr\s+n?c,.*', ((4, 0), (3, 0)), ((4, 0), (3, 5))),             # jr cc,e
+    (r'jp\s+n?c,.*', ((4, 0), (3, 0), (3, 0))),                       # jp cc,nn
+    (r'@?\w+:', ()),                                                  # label
+    (r'', ()),
+]
+
+
+@functools.cache
+def lookup_cycles(instr):
+    """Return the machine cycles of an instruction, when not branching and branching"""
+    line = str(instr)
+    cycles = None
+    for regex, *x in instr_cycles:
+        profile_counts['regex evaluations'] += 1
+        if re.fullmatch(regex, line):
+            cycles = x
+            break
+    if cycles is None:
+        raise Tile2SamError(f"no cycle timings for instruction: {line}")
+    return cycles[0], cycles[-1]
+
+
+def contended_timing(cycles, tstates, slot):
+    """Return the t-state after running machine cycles, with memory accesses aligned to slots"""
+    for access, internal in cycles:
+        tstates += -tstates % slot + access + internal
+    return tstates
+
+
+def parse_value(operand):
+    """Parse a numeric operand, in decimal or &hex"""
+    return int(operand[1:], 16) if operand.startswith('&') else int(operand)
+
+
+class Z80Machine:
+    """Interpreter for the Z80 instructions used by generated code
+
+    Parsed code is run directly rather than assembled, so labels are looked up
+    by name and only the carry flag is modelled. Stores to the operand of the
+    following '@' label instruction, used to restore SP, patch that operand."""
+
+    def __init__(self, code, *, contention='border'):
+        if contention not in CONTENTION_SLOTS:
+            raise Tile2SamError(f"invalid contention model ({contention})")
+
+        self.code = code
+        self.labels = {instr.opcode[:-1]: i for i, instr in enumerate(code) if instr.opcode.endswith(':')}
+        self.memory = bytearray(0x10000)
+        self.regs = dict.fromkeys('abcdehl', 0)
+        self.sp = 0
+        self.carry = False
+        self.slot = CONTENTION_SLOTS[contention]
+
+    def pair(self, rr):
+        return (self.regs[rr[0]] << 8) | self.regs[rr[1]]
+
+    def set_pair(self, rr, value):
+        self.regs[rr[0]], self.regs[rr[1]] = (value >> 8) & 0xff, value & 0xff
+
+    def value(self, operand):
+        if operand in self.regs:
+            return self.regs[operand]
+        elif operand == '(hl)':
+            return self.memory[self.pair('hl')]
+        return parse_value(operand) & 0xff
+
+    def push(self, value):
+        self.sp = (self.sp - 2) & 0xffff
+        self.memory[self.sp], self.memory[(self.sp + 1) & 0xffff] = value & 0xff, value >> 8
+
+    def pop(self):
+        value = self.memory[self.sp] | (self.memory[(self.sp + 1) & 0xffff] << 8)
+        self.sp = (self.sp + 2) & 0xffff
+        return value
+
+    def alu(self, op, operand):
+        a, n = self.regs['a'], self.value(operand)
+        if op in ['add', 'adc']:
+            result = a + n + (op == 'adc' and self.carry)
+            self.carry = result > 0xff
+        elif op in ['sub', 'sbc']:
+            result = a - n - (op == 'sbc' and self.carry)
+            self.carry = result < 0
+        else:
+            result = {'and': a & n, 'or': a | n, 'xor': a ^ n}[op]
+            self.carry = False
+        self.regs['a'] = result & 0xff
+
+    def run(self, label, **pairs):
+        """Call the routine at a label with the given register pairs, returning the t-states taken"""
+        code, labels = self.code, self.labels
+        patches = {}
+        for rr, value in pairs.items():
+            self.set_pair(rr, value)
+
+        self.push(0)  # return address
+        pc = labels[label]
+        tstates = 0
+
+        while True:
+            if pc >= len(code):
+                raise Tile2SamError(f"execution ran past the end of the code from {label}")
+
+            instr = code[pc]
+            op, args = instr.opcode, instr.operands.split(',') if instr.operands else []
+            cond = args[0] if op in ['jr', 'jp', 'ret'] and args and args[0] in ['c', 'nc'] else None
+            taken = cond is None or self.carry == (cond == 'c')
+            tstates = contended_timing(lookup_cycles(instr)[taken], tstates, self.slot)
+            pc += 1
+
+            if op == 'ld' and args[0] == '(hl)':
+                self.memory[self.pair('hl')] = self.value(args[1])
+            elif op == 'ld' and args[0].startswith('(@+'):
+                # Patch the operand of the instruction after the next local label
+                local = '@' + args[0][3:].split('+')[0] + ':'
+                target = next((i for i in range(pc, len(code)) if code[i].opcode == local), None)
+                if target is None:
+                    raise Tile2SamError(f"no local label for instruction: {instr}")
+                patches[target + 1] = self.sp
+            elif op == 'ld' and args[0] == 'sp':
+                self.sp = self.pair('hl') if args[1] == 'hl' else patches.get(pc - 1, parse_value(args[1]))
+            elif op == 'ld' and len(args[0]) == 2:
+                self.set_pair(args[0], parse_value(args[1]) & 0xffff)
+            elif op == 'ld':
+                self.regs[args[0]] = self.value(args[1])
+            elif op == 'ex':
+                hl, de = self.pair('hl'), self.pair('de')
+                self.set_pair('hl', de)
+                self.set_pair('de', hl)
+            elif op == 'push':
+                self.push(self.pair(args[0]))
+            elif op == 'pop':
+                self.set_pair(args[0], self.pop())
+            elif op == 'add' and args[0] == 'hl':
+                result = self.pair('hl') + self.pair(args[1])
+                self.carry = result > 0xffff
+                self.set_pair('hl', result & 0xffff)
+            elif op in ['add', 'adc', 'sub', 'sbc', 'and', 'or', 'xor']:
+                self.alu(op, args[-1])
+            elif op in ['inc', 'dec'] and len(args[0]) == 2:
+                self.set_pair(args[0], (self.pair(args[0]) + (1 if op == 'inc' else -1)) & 0xffff)
+            elif op in ['inc', 'dec']:
+                self.regs[args[0]] = (self.regs[args[0]] + (1 if op == 'inc' else -1)) & 0xff
+            elif op in ['set', 'res']:
+                bit = 1 << int(args[0])
+                self.regs[args[1]] = self.regs[args[1]] | bit if op == 'set' else self.regs[args[1]] & ~bit
+            elif op in ['srl', 'rr']:
+                r = args[0]
+                self.regs[r], self.carry = (self.regs[r] >> 1) | (self.carry << 7 if op == 'rr' else 0), bool(self.regs[r] & 1)
+            elif op == 'scf':
+                self.carry = True
+            elif op in ['ldi', 'ldd']:
+                step = 1 if op == 'ldi' else -1
+                self.memory[self.pair('de')] = self.memory[self.pair('hl')]
+                for rr, delta in [('hl', step), ('de', step), ('bc', -1)]:
+                    self.set_pair(rr, (self.pair(rr) + delta) & 0xffff)
+            elif op == 'ret' and taken:
+                self.pop()
+                return tstates
+            elif op in ['jr', 'jp'] and taken:
+                pc = labels[args[-1]]
+            elif op not in ['ret', 'jr', 'jp'] and not op.endswith(':') and op:
+                raise Tile2SamError(f"can't execute instruction: {instr}")
+
+
+def verify_code(args, code, name, img_tile, *, contention='border'):
+    """Run the routines generated for a tile, checking the display they leave
+
+    Returns the t-states taken by each routine label, at even then odd positions."""
+    base = 0x0000 if args.low else 0x8000
+    other_base, save_buffer = base ^ 0x8000, base + 0x6000
+    background = bytes((i * 97 + 13) & 0xff for i in range(0x6000))
+
+    labels = {instr.opcode[:-1] for instr in code if instr.opcode.endswith(':')}
+    width, height = img_tile.size
+    tile_pixels = img_tile.tobytes()
+    y0 = min(3, max(0, 192 - height))
+    timings = collections.defaultdict(list)
+
+    # Allowed display pixel values for each tile pixel, given the background pixel.
+    # A shared mask covers both positions, so masked draws may clear extra pixels.
+    drawn = {
+        'masked': lambda tile, bkg: ([bkg, 0] if args.share else [bkg]) if tile == TRANSPARENT else [tile],
+        'unmasked': lambda tile, bkg: [bkg, 0] if tile == TRANSPARENT else [tile],
+    }
+
+    def cleared(tile, bkg):
+        return [bkg, 0] if tile == TRANSPARENT else [0]
+
+    for x0 in [0, 1] if args.shift != 0 else [0]:
+        machine = Z80Machine(code, contention=contention)
+        machine.memory[base:base + 0x6000] = machine.memory[other_base:other_base + 0x6000] = background
+        cols = range(x0 // 2, x0 // 2 + (width + 2) // 2 if args.share else (x0 + width + 1) // 2)
+
+        def call(label, allowed=lambda tile, bkg: [bkg], **pairs):
+            """Run a routine, then check the display pixels within the sprite bytes"""
+            machine.sp = (base + 0x8000) & 0xffff
+            tstates = machine.run(label, hl=(y0 << 8) | x0, **pairs)
+            if len(timings[label]) == x0:
+                timings[label].append(tstates)
+
+            screen = machine.memory[base:base + 0x6000]
+            outside = [(0, y0 * 128), ((y0 + height) * 128, len(screen))]
+            outside += [(y * 128 + a, y * 128 + b) for y in range(y0, y0 + height) for a, b in [(0, cols.start), (cols.stop, 128)]]
+            if any(screen[a:b] != background[a:b] for a, b in outside):
+                raise Tile2SamError(f"{label} changed the display outside the sprite at x={x0}")
+
+            for y in range(y0, y0 + height):
+                for x in range(cols.start * 2, cols.stop * 2):
+                    shift = 4 if x % 2 == 0 else 0
+                    pixel = (screen[y * 128 + x // 2] >> shift) & 0x0f
+                    bkg = (background[y * 128 + x // 2] >> shift) & 0x0f
+                    tile = tile_pixels[(y - y0) * width + x - x0] if x - x0 in range(width) else TRANSPARENT
+                    if pixel not in allowed(tile, bkg):
+                        raise Tile2SamError(f"{label} failed verification at sprite pixel ({x - x0},{y - y0}) for x={x0}")
+
+        draw_labels = [(f'{x}_{name}', drawn[x]) for x in drawn if f'{x}_{name}' in labels]
+        restore_labels = [x for x in [f'restore_{name}', f'copy_{name}'] if x in labels]
+        clear_labels = [x for x in [f'clear_{name}', f'clear_rect_{(width + 2) // 2}x{height}'] if x in labels]
+
+        if f'save_{name}' in labels:
+            call(f'save_{name}', de=save_buffer)
+
+        # Draw then restore or clear, which leaves the background for the next routine
+        for label, allowed in draw_labels or [(None, None)]:
+            for restore_label in restore_labels:
+                if label:
+                    call(label, allowed)
+                call(restore_label, de=save_buffer)
+
+            for clear_label in clear_labels:
+                if label:
+                    call(label, allowed)
+                call(clear_label, cleared)
+                machine.memory[base:base + 0x6000] = background
+
+            if label and not restore_labels and not clear_labels:
+                call(label, allowed)
+                machine.memory[base:base + 0x6000] = background
+
+    return timings
+
+###############################################################################
+# Code Cache
+
+
+memory_cache = collections.OrderedDict()
+
+
+def cache_dir():
+    """Return the directory used to cache generated code"""
+    base = os.environ.get('LOCALAPPDATA' if os.name == 'nt' else 'XDG_CACHE_HOME')
+    return os.path.join(base or os.path.expanduser(os.path.join('~', '.cache')), 'tile2sam')
+
+
+@functools.cache
+def source_hash():
+    """Return a hash of this script, so code generator changes invalidate the cache"""
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def cache_key(args, img_tile, idx_tile):
+    """Return the cache key for a tile's code, given the options that affect it"""
+    options = [source_hash(), args.mode, args.code, args.low, args.share, args.shift, args.optimal_regs, args.search_order, args.timing_model,
+               tile_name(args, idx_tile), img_tile.size]
+    key = hashlib.sha256(repr(options).encode())
+    key.update(img_tile.tobytes())
+    return key.hexdigest()
+
+
+def cache_read(key):
+    """Return cached code for the given key, or None if not cached"""
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        return memory_cache[key]
+
+    path = os.path.join(cache_dir(), f'{key}.asm')
+    try:
+        with open(path) as f:
+            text = f.read()
+        os.utime(path)  # mark as recently used
+    except OSError:
+        return None
+
+    memory_cache_add(key, text)
+    return text
+
+
+def cache_exists(key):
+    """Check whether code for the given key is cached"""
+    return key in memory_cache or os.path.isfile(os.path.join(cache_dir(), f'{key}.asm'))
+
+
+def memory_cache_add(key, text):
+    """Keep code in memory for later conversions, dropping the least recently used"""
+    memory_cache[key] = text
+    memory_cache.move_to_end(key)
+    if len(memory_cache) > CACHE_MEMORY_ENTRIES:
+        memory_cache.popitem(last=False)
+
+
+def cache_write(key, text):
+    """Add generated code to the cache"""
+    memory_cache_add(key, text)
+    path = os.path.join(cache_dir(), f'{key}.asm')
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+            f.write(text)
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+    except OSError:
+        pass
+
+
+def cache_evict(max_size=CACHE_MAX_SIZE):
+    """Remove the least recently used cache entries to keep within the size limit"""
+    try:
+        entries = [e for e in os.scandir(cache_dir()) if e.name.endswith('.asm')]
+        entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path) for e in entries), reverse=True)
+    except OSError:
+        return
+
+    total = 0
+    for _, size, path in entries:
+        total += size
+        if total > max_size:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+###############################################################################
+# Incremental Builds
+
+
+def file_stamp(filename):
+    """Return the modification time and size of a file, or None if missing"""
+    try:
+        st = os.stat(filename)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+def input_files(args):
+    """Return the input files used by a conversion"""
+    clut_file = [args.clut] if args.clut and os.path.isfile(args.clut) else []
+    return [args.image, *clut_file]
+
+
+def output_file(args):
+    """Return the main output file name for a conversion"""
+    return args.output or f"{os.path.splitext(args.image)[0]}{'.asm' if args.code else '.bin'}"
+
+
+def deps_filename(args):
+    """Return the dependency file name for a conversion, named after its main output"""
+    return f"{output_file(args)}.d"
+
+
+def build_fingerprint(args, outputs):
+    """Return a hash of the options, inputs and outputs of a conversion"""
+    ignored = ['verbose', 'quiet', 'jobs', 'no_cache', 'batch', 'timings', 'profile', 'watch', 'serve', 'connect', 'shared_clut']
+    options = [(k, v) for k, v in sorted(vars(args).items()) if k not in ignored]
+    fingerprint = hashlib.sha256(repr([source_hash(), options]).encode())
+
+    try:
+        for filename in input_files(args) + outputs:
+            with open(filename, 'rb') as f:
+                fingerprint.update(hashlib.sha256(f.read()).digest())
+    except OSError:
+        return None
+
+    return fingerprint.hexdigest()
+
+
+def up_to_date(args):
+    """Check whether the outputs recorded in the dependency file are current"""
+    if args.append or args.timings or args.output == '-':
+        return False
+
+    try:
+        with open(deps_filename(args)) as f:
+            header = f.readline()
+        record = json.loads(header.removeprefix('# tile2sam:'))
+        outputs, fingerprint = record['outputs'], record['fingerprint']
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+    return fingerprint is not None and build_fingerprint(args, outputs) == fingerprint
+
+
+def write_deps(args, outputs):
+    """Write a make dependency file, recording the build fingerprint"""
+    def escape(filename):
+        return filename.replace('$', '$$').replace(' ', '\\ ')
+
+    record = {'fingerprint': build_fingerprint(args, outputs), 'outputs': outputs}
+    targets = ' '.join(escape(x) for x in outputs)
+    prereqs = ' '.join(escape(x) for x in input_files(args))
+
+    with open(deps_filename(args), 'w') as f:
+        f.write(f"# tile2sam: {json.dumps(record)}\n")
+        if outputs:
+            f.write(f"{targets}: {prereqs}\n")
+
+###############################################################################
+# Profiling
+
+
+profile_times = collections.defaultdict(float)  # seconds spent in each stage
+profile_counts = collections.Counter()
+
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """Add the time spent running a block to the profile for a stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile_times[name] += time.perf_counter() - start
+
+
+def write_profile(filename):
+    """Write the stage timings and counters as JSON to a file, or stderr for '-'"""
+    profile = {
+        'stages_ms': {name: round(secs * 1000, 3) for name, secs in profile_times.items()},
+        'counters': dict(profile_counts),
+    }
+    text = json.dumps(profile, indent=2)
+
+    if filename == '-':
+        print(text, file=sys.stderr)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text + '\n')
 
 ###############################################################################
 # Tile Converters
 
 
-def tile_to_code(args, img_tile, idx_tile):
-    """Generate code routines for the given tile image"""
+def tile_name(args, idx_tile):
+    """Return the label name for the given tile"""
+    names = [x.strip() for x in args.names.split(',')] if args.names else []
+    return names[idx_tile] if idx_tile < len(names) else f'sprite{idx_tile}'
+
+
+def code_routines(args):
+    """Return the list of Z80 routines to generate"""
+    routines = [x.strip() for x in args.code.split(',')]
+    invalid = [x for x in routines if x not in z80_routines]
+    if invalid:
+        raise Tile2SamError(f"invalid routine(s): {invalid}\nvalid routines: {','.join(z80_routines)}")
+    return routines
+
+
+def check_code_options(args):
+    """Check the options used by code generation, returning the routines to generate"""
     if args.mode != 4:
-        sys.exit("error: code generation requires mode 4")
+        raise Tile2SamError("code generation requires mode 4")
     elif args.shift:
-        sys.exit("error: code generation doesn't support non-zero shifts")
+        raise Tile2SamError("code generation doesn't support non-zero shifts")
+    elif args.jobs < 0:
+        raise Tile2SamError(f"invalid job count ({args.jobs})")
+    return code_routines(args)
 
-    names = [x.strip() for x in args.names.split(',')] if args.names else []
-    name = names[idx_tile] if idx_tile < len(names) else f'sprite{idx_tile}'
+
+def alias_code(args, name, orig_name):
+    """Generate label aliases for a sprite identical to an earlier one"""
+    if name == orig_name:
+        return ''
+
+    routines = code_routines(args)
+    if 'save' in routines or 'restore' in routines:
+        routines += ['save', 'restore']
+
+    labels = [x for x in ['masked', 'unmasked', 'save', 'restore', 'copy', 'clear'] if x in routines]
+    code = [''] + [f'{x}_{name}: equ {x}_{orig_name}' for x in labels]
+    if 'save' in labels:
+        code.append(f'save_{name}_size: equ save_{orig_name}_size')
+
+    return format_code(parse_code(code))
+
+
+def tile_to_code(args, img_tile, idx_tile):
+    """Generate code routines for the given tile image"""
+    routines = check_code_options(args)
+
+    name = tile_name(args, idx_tile)
 
     shifted = args.shift != 0
     width_bytes0, width_bytes1 = (img_tile.width + 1) // 2, (img_tile.width + 2) // 2
     width_bytes = width_bytes1
     height = img_tile.height
 
-    img0 = Image.new(img_tile.mode, (width_bytes * 2, height), TRANSPARENT)
-    img1 = Image.new(img_tile.mode, (width_bytes * 2, height), TRANSPARENT)
-    img0.paste(img_tile, (0, 0))
-    img1.paste(img_tile, (1, 0))
-
-    image_data0, mask_data0 = [group_split(x, width_bytes) for x in image_data_bytes(img0.getdata())]
-    image_data1, mask_data1 = [group_split(x, width_bytes) for x in image_data_bytes(img1.getdata())]
-
-    if args.share:
-        mask_data_share = [list(map(operator.or_, a, b)) for a, b in zip(mask_data0, mask_data1)] if shifted else mask_data0
-        mask_data0 = mask_data1 = mask_data_share
-
-    masked_code0 = generate_draw_poke(image_data0, mask_data0)
-    masked_code1 = generate_draw_poke(image_data1, mask_data1)
-    unmasked_code0 = generate_draw_poke(image_data0, mask_data0, masked=False)
-    unmasked_code1 = generate_draw_poke(image_data1, mask_data1, masked=False)
-    save_stack_code0, restore_stack_code0, save_stack_size0 = generate_save_restore_stack(mask_data0)
-    save_stack_code1, restore_stack_code1, save_stack_size1 = generate_save_restore_stack(mask_data1)
-    save_ldi_code0, restore_ldi_code0, save_ldi_size0 = generate_save_restore_ldi(mask_data0)
-    save_ldi_code1, restore_ldi_code1, save_ldi_size1 = generate_save_restore_ldi(mask_data1)
-    restore_copy_code0 = generate_restore_copy(mask_data0, low=args.low)
-    restore_copy_code1 = generate_restore_copy(mask_data1, low=args.low)
-    clear_poke_code0 = generate_draw_poke(None, mask_data0, masked=False)
-    clear_poke_code1 = generate_draw_poke(None, mask_data1, masked=False)
-    clear_push_code0 = generate_clear_push(mask_data0)
-    clear_push_code1 = generate_clear_push(mask_data1)
-    rect_poke_code0 = generate_draw_poke(None, rect_mask(mask_data0), masked=False)
-    rect_poke_code1 = generate_draw_poke(None, rect_mask(mask_data1), masked=False)
-    rect_push_code0 = generate_clear_rect_push(width_bytes0, height)
-    rect_push_code1 = generate_clear_rect_push(width_bytes1, height)
+    model = args.timing_model
+    model_timing = functools.partial(nominal_timing, model=model)
+
+    @functools.cache
+    def tile_bytes(odd):
+        """Image and mask data for the tile at an even or odd x position"""
+        img = Image.new(img_tile.mode, (width_bytes * 2, height), TRANSPARENT)
+        img.paste(img_tile, (odd, 0))
+        return [group_split(x, width_bytes) for x in image_data_bytes(img.getdata())]
+
+    @functools.cache
+    def tile_data(odd):
+        """Image and mask data, with the mask shared by both positions if requested"""
+        image_data, mask_data = tile_bytes(odd)
+
+        if args.share:
+            mask_data = tile_bytes(0)[1]
+            if shifted:
+                mask_data = [list(map(operator.or_, a, b)) for a, b in zip(mask_data, tile_bytes(1)[1])]
+        return image_data, mask_data
+
+    generators = {
+        'masked': lambda odd: generate_draw_poke(*tile_data(odd)),
+        'unmasked': lambda odd: generate_draw_poke(*tile_data(odd), masked=False),
+        'unmasked_push': lambda odd: generate_draw_push(*tile_data(odd), model=model),
+        'masked_optimal': lambda odd: generate_draw_poke(*tile_data(odd), optimal=True),
+        'unmasked_optimal': lambda odd: generate_draw_poke(*tile_data(odd), masked=False, optimal=True),
+        'masked_search': lambda odd: generate_draw_poke(*tile_data(odd), search=True),
+        'unmasked_search': lambda odd: generate_draw_poke(*tile_data(odd), masked=False, search=True),
+        'masked_optimal_search': lambda odd: generate_draw_poke(*tile_data(odd), optimal=True, search=True),
+        'unmasked_optimal_search': lambda odd: generate_draw_poke(*tile_data(odd), masked=False, optimal=True, search=True),
+        'save_stack': lambda odd: generate_save_restore_stack(tile_data(odd)[1]),
+        'save_stack_search': lambda odd: generate_save_restore_stack(tile_data(odd)[1], search=True),
+        'save_ldi': lambda odd: generate_save_restore_ldi(tile_data(odd)[1]),
+        'copy': lambda odd: generate_restore_copy(tile_data(odd)[1], low=args.low),
+        'copy_search': lambda odd: generate_restore_copy(tile_data(odd)[1], low=args.low, search=True),
+        'clear_poke': lambda odd: generate_draw_poke(None, tile_data(odd)[1], masked=False),
+        'clear_push': lambda odd: generate_clear_push(tile_data(odd)[1]),
+        'rect_poke': lambda odd: generate_draw_poke(None, rect_mask(tile_data(odd)[1]), masked=False),
+        'rect_push': lambda odd: generate_clear_rect_push([width_bytes0, width_bytes1][odd], height),
+    }
+
+    @functools.cache
+    def variant(kind, odd):
+        """Generate a routine variant on first use"""
+        with profile_stage(f'generate {kind}'):
+            return generators[kind](odd)
+
+    def draw_variant(kind, odd):
+        """Draw code variant, using optimal register allocation and searched order if requested and faster"""
+        kinds = [kind]
+        if args.optimal_regs:
+            kinds.append(f'{kind}_optimal')
+        if args.search_order:
+            kinds += [f'{x}_search' for x in kinds]
+        return min((variant(x, odd) for x in kinds), key=model_timing)
+
+    def saved_timing(kind, alt):
+        """T-states saved by an alternative routine, negative if it's slower"""
+        saved = [model_timing(variant(kind, x)) - model_timing(variant(alt, x)) for x in [0, 1]]
+        return f"(saved {saved[0]}T / {saved[1]}T)"
 
     if args.timings:
+        def both_timings(*instrs):
+            """Nominal timings, followed by those from a different timing model"""
+            text = ' / '.join(f'{nominal_timing(x)}T' for x in instrs)
+            if model != 'nominal':
+                text += f" ({model} {' / '.join(f'{model_timing(x)}T' for x in instrs)})"
+            return text
+
+        def even_odd_timing(kind):
+            return both_timings(variant(kind, 0), variant(kind, 1))
+
         print(f"Code timings for '{name}':")
-        print(f"  masked draw even/odd = {nominal_timing(masked_code0)}T / {nominal_timing(masked_code1)}T")
-        print(f"  unmasked draw even/odd = {nominal_timing(unmasked_code0)}T / {nominal_timing(unmasked_code1)}T")
-        print(f"  save/restore (mem+stack) = {nominal_timing(save_stack_code0)}T / {nominal_timing(save_stack_code0)}T")
-        print(f"  save/restore (ldi) = {nominal_timing(save_ldi_code0)}T / {nominal_timing(restore_ldi_code0)}T")
-        print(f"  restore (screen) even/odd = {nominal_timing(restore_copy_code0)}T / {nominal_timing(restore_copy_code1)}T")
-        print(f"  clear (poke) even/odd = {nominal_timing(clear_poke_code0)}T / {nominal_timing(clear_poke_code1)}T")
-        print(f"  clear (push) even/odd = {nominal_timing(clear_push_code0)}T / {nominal_timing(clear_push_code1)}T")
-        print(f"  clear rect (poke) even/odd = {nominal_timing(rect_poke_code0)}T / {nominal_timing(rect_poke_code1)}T")
-        print(f"  clear rect (push) even/odd = {nominal_timing(rect_push_code0)}T / {nominal_timing(rect_push_code1)}T")
+        print(f"  masked draw even/odd = {even_odd_timing('masked')}")
+        print(f"  unmasked draw even/odd = {even_odd_timing('unmasked')}")
+        print(f"  unmasked draw (push) even/odd = {even_odd_timing('unmasked_push')}"
+              f" {saved_timing('unmasked', 'unmasked_push')}")
+        if args.optimal_regs:
+            for kind in ['masked', 'unmasked']:
+                print(f"  {kind} draw (optimal regs) even/odd = {even_odd_timing(f'{kind}_optimal')}"
+                      f" {saved_timing(kind, f'{kind}_optimal')}")
+        if args.search_order:
+            for kind in ['masked', 'unmasked']:
+                print(f"  {kind} draw (search order) even/odd = {even_odd_timing(f'{kind}_search')}"
+                      f" {saved_timing(kind, f'{kind}_search')}")
+        print(f"  save/restore (mem+stack) = {both_timings(*variant('save_stack', 0)[:2])}")
+        if args.search_order:
+            print(f"  save/restore (mem+stack, search order) = {both_timings(*variant('save_stack_search', 0)[:2])}")
+        print(f"  save/restore (ldi) = {both_timings(*variant('save_ldi', 0)[:2])}")
+        print(f"  restore (screen) even/odd = {even_odd_timing('copy')}")
+        if args.search_order:
+            print(f"  restore (screen, search order) even/odd = {even_odd_timing('copy_search')}"
+                  f" {saved_timing('copy', 'copy_search')}")
+        print(f"  clear (poke) even/odd = {even_odd_timing('clear_poke')}")
+        print(f"  clear (push) even/odd = {even_odd_timing('clear_push')}")
+        print(f"  clear rect (poke) even/odd = {even_odd_timing('rect_poke')}")
+        print(f"  clear rect (push) even/odd = {even_odd_timing('rect_push')}")
 
     code = []
-    coord_code = ['srl h', 'rr l'] if args.low else ['scf', 'rr h', 'rr l']
-
-    routines = [x.strip() for x in args.code.split(',')]
-    invalid = [x for x in routines if x not in z80_routines]
-    if invalid:
-        sys.exit(f"invalid routine(s): {invalid}\nvalid routines: {','.join(z80_routines)}")
+    coord_code = parse_code(['srl h', 'rr l'] if args.low else ['scf', 'rr h', 'rr l'])
+    odd = 1 if shifted else 0  # unshifted code only needs the even position
 
     if 'masked' in routines:
-        code += branched_code(f'masked_{name}', coord_code, masked_code0, masked_code1, shifted)
+        code += branched_code(f'masked_{name}', coord_code, draw_variant('masked', 0), draw_variant('masked', odd), shifted)
 
     if 'unmasked' in routines:
+        unmasked_code0 = fastest_code([draw_variant('unmasked', 0)], [variant('unmasked_push', 0)], model=model)[0]
+        unmasked_code1 = fastest_code([draw_variant('unmasked', odd)], [variant('unmasked_push', odd)], model=model)[0]
         code += branched_code(f'unmasked_{name}', coord_code, unmasked_code0, unmasked_code1, shifted)
 
     if 'save' in routines or 'restore' in routines:
-        save_code0, restore_code0 = fastest_code([save_stack_code0, restore_stack_code0], [save_ldi_code0, restore_ldi_code0])
-        save_code1, restore_code1 = fastest_code([save_stack_code1, restore_stack_code1], [save_ldi_code1, restore_ldi_code1])
+        save_stack_code0, restore_stack_code0, save_stack_size0 = variant('save_stack', 0)
+        save_stack_code1, restore_stack_code1, save_stack_size1 = variant('save_stack', 1)
+        save_ldi_code0, restore_ldi_code0, save_ldi_size0 = variant('save_ldi', 0)
+        save_ldi_code1, restore_ldi_code1, save_ldi_size1 = variant('save_ldi', 1)
+
+        save_options0 = [[save_stack_code0, restore_stack_code0], [save_ldi_code0, restore_ldi_code0]]
+        save_options1 = [[save_stack_code1, restore_stack_code1], [save_ldi_code1, restore_ldi_code1]]
+        if args.search_order:
+            save_options0.append(variant('save_stack_search', 0)[:2])
+            save_options1.append(variant('save_stack_search', 1)[:2])
+
+        save_code0, restore_code0 = fastest_code(*save_options0, model=model)
+        save_code1, restore_code1 = fastest_code(*save_options1, model=model)
         code += branched_code(f'save_{name}', coord_code, save_code0, save_code1, shifted)
         code += branched_code(f'restore_{name}', coord_code, restore_code0, restore_code1, shifted)
 
         save_stack_size = max(save_stack_size0, save_stack_size1)
         save_ldi_size = max(save_ldi_size0, save_ldi_size1)
-        save_size = save_stack_size if any([x for x in save_code0 if ',sp' in x]) else save_ldi_size
-        code += [f'save_{name}_size: equ {save_size}']
+        save_size = save_stack_size if any([x for x in save_code0 if ',sp' in x.operands]) else save_ldi_size
+        code += [parse_instr(f'save_{name}_size: equ {save_size}')]
 
     if 'copy' in routines:
-        coord_src_code = ['scf', 'rr h', 'rr l'] if args.low else ['srl h', 'rr l']
-        code += branched_code(f'copy_{name}', coord_src_code, restore_copy_code0, restore_copy_code1, shifted)
+        coord_src_code = parse_code(['scf', 'rr h', 'rr l'] if args.low else ['srl h', 'rr l'])
+        copy_kinds = ['copy', 'copy_search'] if args.search_order else ['copy']
+        copy_code0 = min((variant(x, 0) for x in copy_kinds), key=model_timing)
+        copy_code1 = min((variant(x, odd) for x in copy_kinds), key=model_timing)
+        code += branched_code(f'copy_{name}', coord_src_code, copy_code0, copy_code1, shifted)
 
     if 'clear' in routines:
-        clear_code0 = fastest_code([clear_poke_code0], [clear_push_code0])[0]
-        clear_code1 = fastest_code([clear_poke_code1], [clear_push_code1])[0]
+        clear_code0 = fastest_code([variant('clear_poke', 0)], [variant('clear_push', 0)], model=model)[0]
+        clear_code1 = fastest_code([variant('clear_poke', odd)], [variant('clear_push', odd)], model=model)[0]
         code += branched_code(f'clear_{name}', coord_code, clear_code0, clear_code1, shifted)
 
     if 'rect' in routines:
-        rect_code0 = fastest_code([rect_poke_code0], [rect_push_code0])[0]
-        rect_code1 = fastest_code([rect_poke_code1], [rect_push_code1])[0]
+        rect_code0 = fastest_code([variant('rect_poke', 0)], [variant('rect_push', 0)], model=model)[0]
+        rect_code1 = fastest_code([variant('rect_poke', odd)], [variant('rect_push', odd)], model=model)[0]
         code += branched_code(f'clear_rect_{width_bytes}x{height}', coord_code, rect_code0, rect_code1, shifted)
 
+    profile_counts['instructions'] += sum(1 for x in code if x.opcode and not x.opcode.endswith(':'))
+
+    if args.verify:
+        with profile_stage('verify'):
+            measured = [verify_code(args, code, name, img_tile, contention=x) for x in ['border', 'display'][:1 + args.timings]]
+        if args.timings:
+            print(f"Measured timings for '{name}' (border / display contention):")
+            for label, tstates in measured[0].items():
+                for pos, border, display in zip(['even', 'odd'], tstates, measured[1][label]):
+                    print(f"  {label} {pos} = {border}T / {display}T")
+
     return format_code(code)
 
 
-def tile_to_data(args, img_tile):
-    """Convert colour indices to display and mask byte data"""
-    bits_per_pixel = bpp_from_mode(args.mode)
-    pixels_per_byte = 8 // bits_per_pixel
+def tiles_to_code(args, img_clut, tile_indices, tile_boxes):
+    """Generate code routines for the selected tiles, yielding the code for each in selection order"""
+    check_code_options(args)  # also needed when all code comes from the cache
+    img_tiles = [img_clut.crop(box) for box in tile_boxes]
+
+    # Map each tile to the first identical tile, if de-duplicating
+    first_tiles = {}
+    sources = [first_tiles.setdefault(img_tile.tobytes() if args.dedup else pos, pos)
+               for pos, img_tile in enumerate(img_tiles)]
+    unique = [pos for pos, src in enumerate(sources) if pos == src]
+
+    # Reuse previously generated code, unless timings need to be shown or code verified
+    keys = {}
+    use_cache = not args.no_cache and not args.timings and not args.verify
+    if use_cache:
+        for pos in unique:
+            keys[pos] = cache_key(args, img_tiles[pos], tile_indices[pos])
+
+    pending = [pos for pos in unique if not use_cache or not cache_exists(keys[pos])]
+    pending_tiles = [img_tiles[pos] for pos in pending]
+    pending_indices = [tile_indices[pos] for pos in pending]
 
+    if args.verbose and use_cache:
+        print(f"{len(unique) - len(pending)} of {len(unique)} sprite(s) found in code cache")
+
+    profile_counts['tiles generated'] += len(pending)
+    profile_counts['tiles from cache'] += len(unique) - len(pending)
+
+    with contextlib.ExitStack() as stack:
+        # Timings are printed and profiles collected as each tile is generated, so keep those serial
+        if args.jobs == 1 or args.timings or args.profile or len(pending_tiles) < 2:
+            pending_code = map(tile_to_code, itertools.repeat(args), pending_tiles, pending_indices)
+        else:
+            workers = min(args.jobs or os.cpu_count() or 1, len(pending_tiles))
+            chunksize = max(1, len(pending_tiles) // (workers * 4))
+            executor = stack.enter_context(ProcessPoolExecutor(workers))
+            pending_code = executor.map(tile_to_code, itertools.repeat(args), pending_tiles, pending_indices,
+                                        chunksize=chunksize)
+
+        # Yield each tile's code in selection order, as soon as it's available
+        pending = set(pending)
+        for pos, src in enumerate(sources):
+            if pos != src:
+                yield alias_code(args, tile_name(args, tile_indices[pos]), tile_name(args, tile_indices[src]))
+                continue
+
+            text = cache_read(keys[pos]) if pos not in pending else None
+            if text is None:
+                # Also regenerate cached code removed by another process since it was checked
+                text = next(pending_code) if pos in pending else tile_to_code(args, img_tiles[pos], tile_indices[pos])
+                if use_cache:
+                    cache_write(keys[pos], text)
+            yield text
+
+    if use_cache and pending:
+        cache_evict()
+
+
+def tiles_to_data(args, img_clut, tile_boxes):
+    """Pack the selected tiles to display byte data, yielding the data for each tile"""
+    bits_per_pixel = bpp_from_mode(args.mode)
     pad_left = args.shift or 0
-    pad_right = (-(pad_left + img_tile.width) % pixels_per_byte)
 
-    sprite_width = pad_left + img_tile.width + pad_right
-    img_sprite = Image.new(img_tile.mode, (sprite_width, img_tile.height), TRANSPARENT)
-    img_sprite.paste(img_tile, (pad_left, 0))
+    if not tile_boxes:
+        return
 
-    return image_data_bytes(img_sprite.getdata(), bits_per_pixel)[0]
+    # Stack a chunk of tiles vertically in selection order, then let Pillow's
+    # raw packer convert every row at once. Rows are padded to whole bytes on
+    # the right, and transparent pixels are output as CLUT entry 0.
+    tile_width, tile_height = tile_boxes[0][2] - tile_boxes[0][0], tile_boxes[0][3] - tile_boxes[0][1]
+    img_data = img_clut.point(lambda i: 0 if i == TRANSPARENT else i)
 
+    for start in range(0, len(tile_boxes), DATA_CHUNK_TILES):
+        boxes = tile_boxes[start:start + DATA_CHUNK_TILES]
+        img_strip = Image.new('P', (pad_left + tile_width, tile_height * len(boxes)), 0)
 
-def main():
-    """Main Program"""
+        for i, box in enumerate(boxes):
+            img_strip.paste(img_data.crop(box), (pad_left, i * tile_height))
+
+        data = img_strip.tobytes('raw', f'P;{bits_per_pixel}')
+        tile_size = len(data) // len(boxes)
+        for i in range(0, len(data), tile_size):
+            yield data[i:i + tile_size]
+
+
+def index_tiles(tiles, index=None, *, dedup=False, page_size=None):
+    """Yield the tile data to store, adding each tile's data offset to an optional index"""
+    offsets = {}
+    size = 0
+
+    for tile in tiles:
+        if dedup and tile in offsets:
+            offset = offsets[tile]
+        else:
+            # Pad to the next page rather than splitting a tile across pages
+            if page_size and size % page_size + len(tile) > page_size:
+                if len(tile) > page_size:
+                    raise Tile2SamError(f"tile data size ({len(tile)}) too large for {page_size} byte pages")
+                yield bytes(page_size - size % page_size)
+                size += page_size - size % page_size
+
+            offset = size
+            size += len(tile)
+            if dedup:
+                offsets[tile] = offset
+            yield tile
+
+        if index is not None:
+            index.append(offset)
+
+
+def write_pages(data, filename, page_size=PAGE_SIZE):
+    """Write data split into a file for each page, returning the file names and total size"""
+    root, ext = os.path.splitext(filename)
+    filenames, size = [f"{root}_0{ext}"], 0
+    f = open(filenames[0], 'wb', buffering=WRITE_BUFFER_SIZE)
 
     try:
-        pkg_version = version('tile2sam')
-    except PackageNotFoundError:
-        pkg_version = 'unknown'
+        for chunk in data:
+            while chunk:
+                if size and size % page_size == 0:
+                    f.close()
+                    filenames.append(f"{root}_{size // page_size}{ext}")
+                    f = open(filenames[-1], 'wb', buffering=WRITE_BUFFER_SIZE)
 
+                written = f.write(chunk[:page_size - size % page_size])
+                chunk = chunk[written:]
+                size += written
+    finally:
+        f.close()
+
+    return filenames, size
+
+
+def index_entries(index, *, page_size=None):
+    """Return the 16-bit index entries for tile data offsets, as page and offset pairs if paged"""
+    if page_size:
+        return array('H', [x for offset in index for x in divmod(offset, page_size)])
+    elif index and max(index) > 0xffff:
+        raise Tile2SamError(f"tile data offset ({max(index)}) too large for index (try --pages)")
+    return array('H', index)
+
+
+def create_parser(pkg_version):
+    """Create the command-line argument parser"""
     parser = argparse.ArgumentParser(
         prog='tile2sam',
         description="Convert SAM Coupé graphics images to Z80 code or data.",
@@ -831,117 +1965,749 @@ def main():
     parser.add_argument('--scale', help="scale region (S or HxV)")
     parser.add_argument('--shift', default=None, type=int, help="pixels to shift right")
     parser.add_argument('--share', default=False, action='store_true', help="share even/odd save/restore code")
+    parser.add_argument('--optimal-regs', default=False, action='store_true', help="optimal register use in draw code")
+    parser.add_argument('--search-order', default=False, action='store_true', help="search for faster byte visit order in code")
     parser.add_argument('--timings', default=False, action='store_true', help="show nominal code timings")
-    parser.add_argument('image')
+    parser.add_argument('--timing-model', default='nominal', choices=TIMING_MODELS, metavar='MODEL',
+                        help="timings used to choose code (nominal, border, display)")
+    parser.add_argument('--verify', default=False, action='store_true', help="check generated code in a Z80 interpreter")
+    parser.add_argument('--no-cache', default=False, action='store_true', help="don't use cached sprite code")
+    parser.add_argument('--dedup', default=False, action='store_true', help="store identical tiles only once")
+    parser.add_argument('--pages', nargs='?', const='image', choices=['image', 'files'], metavar='LAYOUT',
+                        help="pack tile data into 16K pages, as one image or a file per page (image, files)")
+    parser.add_argument('--bands', default=False, action='store_true', help="convert tile data one tile row at a time")
+    parser.add_argument('-j', '--jobs', default=1, type=int, help="parallel code generation jobs (0 for all cores)")
+    parser.add_argument('--deps', default=False, action='store_true', help="write .d file and skip up-to-date outputs")
+    parser.add_argument('--batch', metavar='MANIFEST', help="JSON manifest of conversion jobs")
+    parser.add_argument('--shared-clut', default=False, action='store_true', help="share CLUTs between batch jobs")
+    parser.add_argument('--watch', default=False, action='store_true', help="convert again when inputs change")
+    parser.add_argument('--serve', metavar='SOCKET', help="run a conversion server on a Unix socket")
+    parser.add_argument('--connect', metavar='SOCKET', help="send the conversion to a server")
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE', help="write stage timings as JSON (to stderr if no FILE)")
+    parser.add_argument('image', nargs='?')
     parser.add_argument('tilesize', default=None, type=str, nargs='?', help="tile size (WxH or W)")
-    args = parser.parse_args()
+    return parser
+
+
+image_cache = collections.OrderedDict()
+
+
+def open_image(image):
+    """Open and decode an image from a filename, file data or existing image"""
+    if isinstance(image, Image.Image):
+        return image
 
     try:
-        img = Image.open(args.image)
-    except BaseException as err:
-        sys.exit(str(err))
+        with profile_stage('decode'):
+            img = Image.open(io.BytesIO(image) if isinstance(image, (bytes, bytearray)) else image)
+            img.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as err:
+        raise Tile2SamError(str(err)) from err
+    return img
 
-    if args.verbose:
-        print(f"Source image: {args.image} ({img.size[0]}x{img.size[1]})")
 
+def prepare_image(args, img):
+    """Crop, scale and palettise a source image"""
     if args.crop:
-        img = crop_image(img, args.crop)
+        with profile_stage('crop'):
+            img = crop_image(img, args.crop)
         if args.verbose:
             print(f"Cropped to: {img.size[0]}x{img.size[1]}")
 
     if args.scale:
-        img = scale_image(img, args.scale)
+        with profile_stage('scale'):
+            img = scale_image(img, args.scale)
         if args.verbose:
             print(f"Scaled to: {img.size[0]}x{img.size[1]}")
 
     sam_palette = generate_sam_palette()
-    bkg_cols, img_pal = palettise_image(img, sam_palette, args.bkgcol)
+    with profile_stage('palettise'):
+        bkg_cols, img_pal = palettise_image(img, sam_palette, args.bkgcol)
 
+    return img, bkg_cols, img_pal
+
+
+def load_image(args):
+    """Open, crop, scale and palettise the source image, reusing earlier work"""
+    path = os.path.abspath(args.image)
+    key = (path, file_stamp(path), args.crop, args.scale, args.bkgcol)
+    if key in image_cache:
+        image_cache.move_to_end(key)
+        return image_cache[key]
+
+    img = open_image(args.image)
+    if args.verbose:
+        print(f"Source image: {args.image} ({img.size[0]}x{img.size[1]})")
+
+    # Forget earlier versions of a changed image
+    for old_key in [k for k in image_cache if k[0] == path and k[1] != key[1]]:
+        del image_cache[old_key]
+
+    image_cache[key] = prepare_image(args, img)
+    if len(image_cache) > IMAGE_CACHE_ENTRIES:
+        image_cache.popitem(last=False)
+    return image_cache[key]
+
+
+def clut_colours(colours, bkg_cols):
+    """Return the colours used by an image that need CLUT entries"""
+    return sorted([c for c in colours if c == 0 or c not in bkg_cols])
+
+
+def choose_clut(args, colours, bkg_cols):
+    """Choose the CLUT for the SAM colours used by an image"""
     bits_per_pixel = bpp_from_mode(args.mode)
 
-    palette = sorted([c[1] for c in img_pal.getcolors() if c[1] == 0 or c[1] not in bkg_cols])
+    palette = clut_colours(colours, bkg_cols)
     if len(palette) > (1 << bits_per_pixel):
-        print(palette)
-        sys.exit(f"error: too many colours ({len(palette)}) for screen mode {args.mode}")
+        raise Tile2SamError(f"too many colours ({len(palette)}) for screen mode {args.mode}: {palette}")
 
     if args.clut is None:
-        basic_clut = [0,16,32,48,64,80,96,120,0,17,34,51,68,85,102,127]  # noqa: E231
-        clut = basic_clut if args.mode == 4 and set(palette).issubset(basic_clut) else palette
+        clut = list(BASIC_CLUT) if args.mode == 4 and set(palette).issubset(BASIC_CLUT) else palette
     else:
         clut = read_palette(args.clut)
         clut += list(set(palette).difference(set(clut)))
 
     if len(clut) > (1 << bits_per_pixel):
-        sys.exit(f"error: clut has too many entries ({len(clut)}) for mode {args.mode}")
-
-    img_clut = clutise_image(img_pal, clut, bkg_cols)
+        raise Tile2SamError(f"clut has too many entries ({len(clut)}) for mode {args.mode}")
 
     if args.verbose:
         print(f"CLUT ({len(clut)} colours): {clut}")
         print(f"Background colours: {bkg_cols}")
 
-    gfx_data, index_data = [], []
-    code_text = ''
-    num_tiles = 0
+    return clut
 
-    if args.tilesize is not None:
-        tile_width, tile_height = get_tile_size(args.tilesize)
 
-        tiles_x = img.width // tile_width
-        tiles_y = img.height // tile_height
-        tile_select = get_tile_selection(args.tiles, tiles_x * tiles_y)
-        img.crop((0, 0, tiles_x * tile_width, tiles_y * tile_height))
+def image_clut(args, img_pal, bkg_cols):
+    """Choose the CLUT for an image, returning it with the image mapped to CLUT indices"""
+    clut = choose_clut(args, [c[1] for c in img_pal.getcolors()], bkg_cols)
 
-        if not tiles_x or not tiles_y:
-            sys.exit(f"error: source image too small for {tile_width}x{tile_height} tiles")
-        elif args.verbose:
-            print(f"Contains {tiles_x}x{tiles_y} grid of {tile_width}x{tile_height} tiles")
+    with profile_stage('clutise'):
+        img_clut = clutise_image(img_pal, clut, bkg_cols)
 
-        for start, end in tile_select:
-            step = +1 if start <= end else -1
-            for idx_tile in range(start, end + step, step):
-                x = (idx_tile % tiles_x) * tile_width
-                y = (idx_tile // tiles_x) * tile_height
+    return clut, img_clut
 
-                img_tile = img_clut.crop((x, y, x + tile_width, y + tile_height))
 
-                if args.code:
-                    code_text += tile_to_code(args, img_tile, idx_tile)
-                else:
-                    index_data.append(len(gfx_data))
-                    gfx_data += tile_to_data(args, img_tile)
+def image_tiles(args, size):
+    """Return the indices and boxes of the selected tiles for an image size, if a tile size is given"""
+    if args.tilesize is None:
+        return [], []
+
+    tile_width, tile_height = get_tile_size(args.tilesize)
+
+    tiles_x = size[0] // tile_width
+    tiles_y = size[1] // tile_height
+    tile_select = get_tile_selection(args.tiles, tiles_x * tiles_y)
+
+    if not tiles_x or not tiles_y:
+        raise Tile2SamError(f"source image too small for {tile_width}x{tile_height} tiles")
+    elif args.verbose:
+        print(f"Contains {tiles_x}x{tiles_y} grid of {tile_width}x{tile_height} tiles")
+
+    tile_indices = []
+    for start, end in tile_select:
+        step = +1 if start <= end else -1
+        tile_indices += range(start, end + step, step)
+
+    tile_boxes = []
+    for idx_tile in tile_indices:
+        x = (idx_tile % tiles_x) * tile_width
+        y = (idx_tile // tiles_x) * tile_height
+        tile_boxes.append((x, y, x + tile_width, y + tile_height))
+
+    profile_counts['tiles'] += len(tile_boxes)
+    return tile_indices, tile_boxes
+
+
+def band_layout(args, img):
+    """Return the crop box, final size and source row of each output row, for converting in bands"""
+    crop = crop_box(args.crop) if args.crop else (0, 0, *img.size)
+    width, height = crop[2] - crop[0], crop[3] - crop[1]
+    size = scale_size((width, height), args.scale) if args.scale else [width, height]
+
+    if args.verbose and args.crop:
+        print(f"Cropped to: {width}x{height}")
+    if args.verbose and args.scale:
+        print(f"Scaled to: {size[0]}x{size[1]}")
+
+    # Resize a column of row numbers, to sample the same rows as scaling the whole image
+    rows = Image.frombytes('I', (1, height), array('i', range(height)).tobytes())
+    src_rows = array('i', rows.resize((1, size[1]), Image.Resampling.NEAREST).tobytes())
+    return crop, size, src_rows
 
-                num_tiles += 1
+
+def image_bands(img, layout, band_height, count=None):
+    """Yield bands of rows from the cropped and scaled image, without creating the full image"""
+    crop, (width, height), src_rows = layout
+    num_bands = (height + band_height - 1) // band_height
+
+    for y in range(0, min(num_bands, count or num_bands) * band_height, band_height):
+        rows = src_rows[y:y + band_height]
+        top, bottom = min(rows), max(rows) + 1
+
+        band = img.crop((crop[0], crop[1] + top, crop[2], crop[1] + bottom))
+        if band.width != width:
+            band = band.resize((width, band.height), Image.Resampling.NEAREST)
+
+        # Repeat or skip source rows, as scaling does
+        if list(rows) != list(range(top, bottom)):
+            scaled = band.crop((0, 0, width, len(rows)))
+            for i, row in enumerate(rows):
+                scaled.paste(band.crop((0, row - top, width, row - top + 1)), (0, i))
+            band = scaled
+
+        yield band
+
+
+def band_tiles(args):
+    """Convert the image one tile row at a time, returning the CLUT, tile boxes and a generator of tile data"""
+    if args.code:
+        raise Tile2SamError("--bands doesn't support code generation")
+    elif args.tilesize is None:
+        raise Tile2SamError("--bands requires a tile size")
+
+    img = open_image(args.image)
+    if args.verbose:
+        print(f"Source image: {args.image} ({img.size[0]}x{img.size[1]})")
+
+    layout = band_layout(args, img)
+    tile_width, tile_height = get_tile_size(args.tilesize)
+
+    # First pass finds the colours used, and the alpha of the last pixel using each
+    sam_palette = generate_sam_palette()
+    colours, alpha_map = set(), {}
+    for band in image_bands(img, layout, tile_height):
+        with profile_stage('palettise'):
+            band_pal, band_alpha = map_colours(band, sam_palette)
+            band_colours = [c for _, c in band_pal.getcolors()]
+            colours.update(band_colours)
+            if band_alpha.getextrema()[0] == 0:
+                alpha_map.update(zip(band_pal.tobytes(), band_alpha.tobytes()))
+            else:
+                alpha_map.update(dict.fromkeys(band_colours, 0xff))
+
+    transp_cols = sorted([i for i, a in alpha_map.items() if a == 0])
+    bkg_cols = [args.bkgcol] if args.bkgcol is not None else transp_cols or [0]
+    clut = choose_clut(args, colours, bkg_cols)
+
+    tile_indices, tile_boxes = image_tiles(args, layout[1])
+    if any(a > b for a, b in zip(tile_indices, tile_indices[1:])):
+        raise Tile2SamError("--bands requires tiles selected in ascending order")
+
+    def band_data():
+        row_boxes = collections.defaultdict(list)
+        for x0, y0, x1, _ in tile_boxes:
+            row_boxes[y0 // tile_height].append((x0, 0, x1, tile_height))
+
+        # Second pass maps each band to CLUT entries and packs its selected tiles
+        for row, band in enumerate(image_bands(img, layout, tile_height, max(row_boxes) + 1)):
+            if row in row_boxes:
+                band_pal, _ = map_colours(band, sam_palette)
+                yield from tiles_to_data(args, clutise_image(band_pal, clut, bkg_cols), row_boxes[row])
+
+    return clut, tile_boxes, band_data()
+
+
+def convert_file(args):
+    """Convert an image file, writing the outputs selected by the command-line options"""
+    if args.shared_clut:
+        raise Tile2SamError("--shared-clut requires --batch")
+
+    if args.deps and up_to_date(args):
+        if args.verbose:
+            print(f"Outputs from {args.image} are up to date")
+        return
+
+    if args.bands:
+        clut, tile_boxes, tiles = band_tiles(args)
+    else:
+        img, bkg_cols, img_pal = load_image(args)
+        clut, img_clut = image_clut(args, img_pal, bkg_cols)
+        tile_indices, tile_boxes = image_tiles(args, img.size)
+        tiles = tiles_to_data(args, img_clut, tile_boxes)
 
     basename = os.path.splitext(args.output or args.image)[0]
+    outputs = []
+    index_data = array('L')
+    page_size = PAGE_SIZE if args.pages else None
+
+    # Tile data and code are written as they are generated, so those stages include their output time
+    if tile_boxes and not args.code:
+        with profile_stage('tile data'):
+            filename = args.output or f"{basename}.bin"
+            tiles = index_tiles(tiles, index_data, dedup=args.dedup, page_size=page_size)
+            if args.pages and args.append:
+                raise Tile2SamError("--pages can't be used with --append")
+            elif args.pages == 'files':
+                filenames, data_size = write_pages(tiles, filename)
+                outputs += filenames
+            else:
+                data_size = 0
+                with open(filename, 'ab+' if args.append else 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                    for tile in tiles:
+                        data_size += f.write(tile)
+                outputs.append(filename)
 
-    if gfx_data:
-        filename = args.output or f"{basename}.bin"
-        with open(filename, 'ab+' if args.append else 'wb') as f:
-            f.write(bytearray(gfx_data))
         if args.verbose:
-            print(f"{num_tiles} tile(s) of size {tile_width}x{tile_height} "
-                  f"for mode {args.mode} = {len(gfx_data)} bytes")
-            print(f"Data written to {filename}")
-
-    if args.pal:
-        with open(f"{basename}.pal", 'wb') as f:
-            f.write(bytearray(clut))
-
-    if args.index and index_data:
-        with open(f"{basename}.idx", 'wb') as f:
-            f.write(bytearray(struct.pack(f">{len(index_data)}H", *index_data)))
-
-    if code_text:
-        filename = args.output or f"{basename}.asm"
-        if filename == "-":
-            print(code_text)
+            tile_width, tile_height = tile_boxes[0][2] - tile_boxes[0][0], tile_boxes[0][3] - tile_boxes[0][1]
+            print(f"{len(tile_boxes)} tile(s) of size {tile_width}x{tile_height} "
+                  f"for mode {args.mode} = {data_size} bytes")
+            if args.dedup:
+                print(f"{len(set(index_data))} unique tile(s) after de-duplication")
+            if args.pages:
+                print(f"Data packed into {(data_size + PAGE_SIZE - 1) // PAGE_SIZE} page(s) of {PAGE_SIZE} bytes")
+            if args.pages == 'files':
+                print(f"Data written to {filenames[0]} to {filenames[-1]}")
+            else:
+                print(f"Data written to {filename}")
+
+    with profile_stage('write'):
+        if args.pal:
+            with open(f"{basename}.pal", 'wb') as f:
+                f.write(bytearray(clut))
+            outputs.append(f"{basename}.pal")
+
+        if args.index and index_data:
+            entries = index_entries(index_data, page_size=page_size)
+            if sys.byteorder == 'little':
+                entries.byteswap()  # big-endian entries
+            with open(f"{basename}.idx", 'wb') as f:
+                entries.tofile(f)
+            outputs.append(f"{basename}.idx")
+
+    if tile_boxes and args.code:
+        with profile_stage('tile code'):
+            code = tiles_to_code(args, img_clut, tile_indices, tile_boxes)
+            filename = args.output or f"{basename}.asm"
+            if filename == "-":
+                sys.stdout.writelines(code)
+                print()
+            elif args.append:
+                # Generate the first tile before appending, so invalid options leave the file unchanged
+                code = itertools.chain([next(code)], code)
+                with open(filename, 'a+', buffering=WRITE_BUFFER_SIZE) as f:
+                    f.write("; tile2sam generated code\n")
+                    f.writelines(code)
+                outputs.append(filename)
+            else:
+                # Replace any existing output only once all the code has been generated
+                temp_filename = f'{filename}.{os.getpid()}.tmp'
+                try:
+                    with open(temp_filename, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+                        f.write("; tile2sam generated code\n")
+                        f.writelines(code)
+                    os.replace(temp_filename, filename)
+                finally:
+                    if os.path.exists(temp_filename):
+                        os.remove(temp_filename)
+                outputs.append(filename)
+
+        if args.verbose and filename != "-":
+            print(f"Code {'appended' if args.append else 'written'} to {filename}")
+
+    if args.deps and args.output != '-':
+        write_deps(args, outputs)
+
+
+def manifest_job_args(job):
+    """Convert a manifest job object to a list of command-line arguments"""
+    if not isinstance(job, dict) or 'image' not in job:
+        raise Tile2SamError(f"invalid manifest job: {job}")
+
+    argv = []
+    for key, value in job.items():
+        if key in ['image', 'tilesize', 'batch']:
+            continue
+        elif isinstance(value, list):
+            value = ','.join(str(x) for x in value)
+
+        option = f"--{key.replace('_', '-')}"
+        if value is True:
+            argv.append(option)
+        elif value is not False and value is not None:
+            argv += [option, str(value)]
+
+    argv.append(str(job['image']))
+    if job.get('tilesize') is not None:
+        argv.append(str(job['tilesize']))
+    return argv
+
+
+def read_manifest(parser, manifest):
+    """Read a manifest file, returning the parsed arguments for each job"""
+    try:
+        with open(manifest) as f:
+            jobs = json.load(f)
+    except (OSError, ValueError) as err:
+        raise Tile2SamError(f"invalid manifest: {err}")
+
+    if isinstance(jobs, dict):
+        jobs = jobs.get('jobs')
+    if not isinstance(jobs, list):
+        raise Tile2SamError("manifest should contain a list of jobs")
+
+    return [parser.parse_args(manifest_job_args(job)) for job in jobs]
+
+
+def job_colours(job):
+    """Return the SAM colours that need CLUT entries for a conversion job"""
+    img, bkg_cols, img_pal = load_image(job)
+    colours = clut_colours([c for _, c in img_pal.getcolors()], bkg_cols)
+
+    if len(colours) > (1 << bpp_from_mode(job.mode)):
+        raise Tile2SamError(f"too many colours ({len(colours)}) for screen mode {job.mode} in {job.image}")
+    return colours
+
+
+def shared_cluts(colour_sets, size):
+    """Return CLUTs shared by sets of colours, and the CLUT to use for each set"""
+    # Place the largest sets first, each in the group it adds fewest colours to
+    groups, set_groups = [], {}
+    for i in sorted(range(len(colour_sets)), key=lambda i: -len(colour_sets[i])):
+        fits = [g for g, group in enumerate(groups) if len(group | colour_sets[i]) <= size]
+        g = min(fits, key=lambda g: len(groups[g] | colour_sets[i]), default=len(groups))
+        if g == len(groups):
+            groups.append(set())
+        groups[g] |= colour_sets[i]
+        set_groups[i] = g
+
+    # Give each group a CLUT in order of first use, leaving colours in the same
+    # slots as the previous CLUT so switching reloads as few entries as possible
+    cluts, group_cluts, clut = [], {}, []
+    for g in dict.fromkeys(set_groups[i] for i in range(len(colour_sets))):
+        if size == len(BASIC_CLUT) and groups[g].issubset(BASIC_CLUT):
+            clut = list(BASIC_CLUT)
+        else:
+            clut = list(clut)
+            free = [slot for slot, c in enumerate(clut) if c not in groups[g]]
+            for c in sorted(groups[g].difference(clut)):
+                if free:
+                    clut[free.pop(0)] = c
+                else:
+                    clut.append(c)
+
+        group_cluts[g] = len(cluts)
+        cluts.append(clut)
+
+    return cluts, [group_cluts[set_groups[i]] for i in range(len(colour_sets))]
+
+
+def share_cluts(jobs, *, verbose=False):
+    """Set the CLUT for each job to one shared with as many other jobs as possible"""
+    # Jobs with a custom CLUT keep it, and others share CLUTs with jobs of the same size
+    shared = [job for job in jobs if job.clut is None]
+    for size in sorted({1 << bpp_from_mode(job.mode) for job in shared}):
+        size_jobs = [job for job in shared if 1 << bpp_from_mode(job.mode) == size]
+        cluts, job_cluts = shared_cluts([set(job_colours(job)) for job in size_jobs], size)
+
+        for job, n in zip(size_jobs, job_cluts):
+            job.clut = ','.join(str(c) for c in cluts[n])
+
+        if verbose:
+            for n, clut in enumerate(cluts):
+                reloads = sum(a != b for a, b in zip(cluts[n - 1], clut)) if n else len(clut)
+                images = ', '.join(dict.fromkeys(job.image for job, m in zip(size_jobs, job_cluts) if m == n))
+                print(f"Shared CLUT {n} ({len(clut)} colours, {reloads} to load): {clut} for {images}")
+
+
+def run_job_chain(jobs):
+    """Run conversion jobs in order"""
+    for job in jobs:
+        convert_file(job)
+
+
+def run_batch(parser, manifest, *, shared_clut=False, workers=1, verbose=False):
+    """Run all conversion jobs listed in a manifest file"""
+    jobs = read_manifest(parser, manifest)
+
+    # Paths in the manifest are relative to the manifest file
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(os.path.abspath(manifest)))
+    try:
+        if shared_clut:
+            share_cluts(jobs, verbose=verbose)
+
+        # Jobs writing outputs with the same name are kept in order in the same worker
+        chains = {}
+        for job in jobs:
+            chains.setdefault(os.path.splitext(os.path.abspath(output_file(job)))[0], []).append(job)
+
+        if workers == 1 or len(chains) < 2:
+            run_job_chain(jobs)
+        elif workers < 0:
+            raise Tile2SamError(f"invalid job count ({workers})")
         else:
-            with open(filename, 'a+' if args.append else 'w') as f:
-                f.write("; tile2sam generated code\n")
-                f.write(code_text)
-            if args.verbose:
-                print(f"Code {'appended' if args.append else 'written'} to {filename}")
+            with ProcessPoolExecutor(min(workers or os.cpu_count() or 1, len(chains))) as executor:
+                list(executor.map(run_job_chain, chains.values()))
+    finally:
+        os.chdir(cwd)
+
+
+def watch(parser, args):
+    """Convert again whenever the source images, palettes or manifest change, until interrupted"""
+    if args.append and not args.batch:
+        raise Tile2SamError("--watch can't be used with --append")
+
+    if args.shared_clut:
+        raise Tile2SamError("--watch can't be used with --shared-clut")
+
+    manifest = os.path.abspath(args.batch) if args.batch else None
+    manifest_stamp, jobs, job_stamps = None, [] if manifest else [args], {}
+    print("Watching for changes (Ctrl-C to stop)")
+
+    cwd = os.getcwd()
+    if manifest:
+        os.chdir(os.path.dirname(manifest))
+    try:
+        while True:
+            if manifest and file_stamp(manifest) != manifest_stamp:
+                manifest_stamp = file_stamp(manifest)
+                try:
+                    jobs = read_manifest(parser, manifest)
+                except Tile2SamError as err:
+                    print(f"error: {err}")
+
+            # Jobs are identified by their options, so edited manifest jobs are treated as changed
+            stamps = [(repr(sorted(vars(job).items())), [file_stamp(x) for x in input_files(job)]) for job in jobs]
+            changed = {i for i, stamp in enumerate(stamps) if job_stamps.get(stamp[0]) != stamp[1]}
+
+            # Jobs appending to the same output must all be run again, in order
+            for i in list(changed):
+                shared = [j for j, job in enumerate(jobs) if output_file(job) == output_file(jobs[i])]
+                if any(jobs[j].append for j in shared):
+                    changed.update(shared)
+
+            for i in sorted(changed):
+                start = time.perf_counter()
+                try:
+                    convert_file(jobs[i])
+                    print(f"Converted {jobs[i].image} in {(time.perf_counter() - start) * 1000:.0f}ms")
+                except Tile2SamError as err:
+                    print(f"error: {err}")
+
+            job_stamps = dict(stamps)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.chdir(cwd)
+
+###############################################################################
+# Conversion Server
+
+
+# Client options not forwarded to the server
+CLIENT_OPTIONS = ['connect', 'serve', 'watch', 'profile']
+
+
+def serve_request(parser, request):
+    """Run a client's conversion job, returning the exit status and console output"""
+    stdout, stderr = io.StringIO(), io.StringIO()
+    cwd = os.getcwd()
+    status = 0
+
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            os.chdir(request.get('cwd', cwd))
+            job = request.get('job')
+            if isinstance(job, dict) and job.get('batch'):
+                run_batch(parser, job['batch'], shared_clut=job.get('shared_clut'), workers=job.get('jobs', 1),
+                          verbose=job.get('verbose'))
+            else:
+                convert_file(parser.parse_args(manifest_job_args(job)))
+    except Tile2SamError as err:
+        stderr.write(f"error: {err}\n")
+        status = 1
+    except SystemExit as err:  # from argument parsing
+        status = err.code if isinstance(err.code, int) else 1
+    except OSError as err:
+        stderr.write(f"error: {err}\n")
+        status = 1
+    except Exception:  # unexpected failure, reported as the command-line tool would
+        stderr.write(traceback.format_exc())
+        status = 1
+    finally:
+        os.chdir(cwd)
+
+    return {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handle a conversion request, given as a line of JSON"""
+
+    def __init__(self, *args, parser, **kwargs):
+        self.parser = parser  # set first, as the base class handles the request
+        super().__init__(*args, **kwargs)
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:  # connection check
+            return
+
+        try:
+            response = serve_request(self.parser, json.loads(line))
+        except (ValueError, AttributeError) as err:
+            response = {'status': 1, 'stdout': '', 'stderr': f"error: invalid request: {err}\n"}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+def send_request(path, request):
+    """Send a request to a conversion server, returning its response"""
+    if not hasattr(socket, 'AF_UNIX'):
+        raise Tile2SamError("conversion server requires Unix domain sockets")
+
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline())
+    except (OSError, ValueError) as err:
+        raise Tile2SamError(f"conversion server on {path} failed: {err}")
+
+
+def serve(parser, path):
+    """Run conversion requests from clients until interrupted, keeping decoded images and code in memory"""
+    if not hasattr(socket, 'AF_UNIX'):
+        raise Tile2SamError("conversion server requires Unix domain sockets")
+
+    # Replace a socket left behind by a server that's no longer running
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX) as sock:
+            if sock.connect_ex(path) == 0:
+                raise Tile2SamError(f"server already running on {path}")
+        os.remove(path)
+
+    # Requests are handled one at a time, as each may change the working directory
+    with socketserver.UnixStreamServer(path, functools.partial(RequestHandler, parser=parser)) as server:
+        print(f"Serving conversions on {path} (Ctrl-C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+
+def connect(path, args):
+    """Forward a conversion to a server, returning the exit status"""
+    job = {k: v for k, v in vars(args).items() if k not in CLIENT_OPTIONS}
+    response = send_request(path, {'cwd': os.getcwd(), 'job': job})
+
+    sys.stdout.write(response.get('stdout', ''))
+    sys.stderr.write(response.get('stderr', ''))
+    return response.get('status', 1)
+
+###############################################################################
+# Python API
+
+
+# Options accepted by convert(), named after the long command-line options
+API_OPTIONS = ['mode', 'clut', 'bkgcol', 'tiles', 'code', 'names', 'low', 'crop', 'scale', 'shift', 'share',
+               'optimal_regs', 'search_order', 'timing_model', 'verify', 'no_cache', 'dedup', 'jobs']
+
+
+class Conversion(NamedTuple):
+    """Outputs of an image conversion: tile data or code, with the CLUT and tile data index"""
+    data: bytes
+    palette: list[int]
+    index: list[int]
+    code: str
+
+
+def api_args(tilesize, options):
+    """Return conversion options in the same form as parsed command-line arguments"""
+    unknown = [x for x in options if x not in API_OPTIONS]
+    if unknown:
+        raise TypeError(f"unknown conversion option(s): {', '.join(unknown)}")
+
+    parser = create_parser('')
+    actions = {action.dest: action for action in parser._actions}
+    args = parser.parse_args([])
+
+    # Convert values to the types the parser would produce from the command line
+    for key, value in options.items():
+        action = actions[key]
+        if value is None:
+            pass
+        elif action.nargs == 0:  # flag option
+            if not isinstance(value, bool):
+                raise Tile2SamError(f"invalid {key} option ({value!r}), should be True or False")
+        else:
+            if isinstance(value, (list, tuple)):
+                value = ','.join(str(x) for x in value)
+            try:
+                value = action.type(str(value)) if action.type else str(value)
+            except (TypeError, ValueError):
+                raise Tile2SamError(f"invalid {key} option ({value!r})")
+            if action.choices and value not in action.choices:
+                raise Tile2SamError(f"invalid {key} option ({value!r}), should be one of: {', '.join(action.choices)}")
+        setattr(args, key, value)
+
+    if isinstance(tilesize, (list, tuple)):
+        tilesize = 'x'.join(str(x) for x in tilesize)
+    args.tilesize = None if tilesize is None else str(tilesize)
+    return args
+
+
+def convert(image, tilesize=None, **options):
+    """Convert an image, image file data or filename, returning the outputs as a Conversion
+
+    Options use the long command-line option names, with underscores for hyphens.
+    Lists are accepted for comma-separated values, e.g. code=['masked', 'save'].
+    Raises Tile2SamError for invalid options or images.
+    """
+    args = api_args(tilesize, options)
+
+    img, bkg_cols, img_pal = prepare_image(args, open_image(image))
+    clut, img_clut = image_clut(args, img_pal, bkg_cols)
+    tile_indices, tile_boxes = image_tiles(args, img.size)
+
+    data, index, code = b'', array('L'), ''
+    if tile_boxes and args.code:
+        code = ''.join(tiles_to_code(args, img_clut, tile_indices, tile_boxes))
+    elif tile_boxes:
+        data = b''.join(index_tiles(tiles_to_data(args, img_clut, tile_boxes), index, dedup=args.dedup))
+
+    return Conversion(data, clut, index.tolist(), code)
+
+###############################################################################
+# Main Program
+
+
+def main():
+    """Main Program"""
+
+    try:
+        pkg_version = version('tile2sam')
+    except PackageNotFoundError:
+        pkg_version = 'unknown'
+
+    parser = create_parser(pkg_version)
+    args = parser.parse_args()
+
+    try:
+        with profile_stage('total'):
+            if args.serve:
+                serve(parser, args.serve)
+            elif args.connect and (args.batch or args.image):
+                status = connect(args.connect, args)
+                if status:
+                    sys.exit(status)
+            elif args.watch and (args.batch or args.image):
+                watch(parser, args)
+            elif args.batch:
+                run_batch(parser, args.batch, shared_clut=args.shared_clut, workers=args.jobs, verbose=args.verbose)
+            elif args.image is None:
+                parser.error("the following arguments are required: image")
+            else:
+                convert_file(args)
+    except Tile2SamError as err:
+        sys.exit(f"error: {err}")
+
+    if args.profile:
+        write_profile(args.profile)
 
 
 if __name__ == "__main__":
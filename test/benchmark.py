@@ -0,0 +1,201 @@
+"""Benchmark tile2sam conversion stages using synthetic images
+
+Results can be written as JSON with --output, and compared against earlier
+results with --baseline, failing if any benchmark is slower by more than the
+threshold. Timings depend on the machine, so keep a baseline for each one.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from PIL import Image  # noqa: E402
+
+from tile2sam.tile2sam import (  # noqa: E402
+    TRANSPARENT,
+    clutise_image,
+    generate_clear_push,
+    generate_clear_rect_push,
+    generate_draw_poke,
+    generate_draw_push,
+    generate_restore_copy,
+    generate_sam_palette,
+    generate_save_restore_ldi,
+    generate_save_restore_stack,
+    group_split,
+    image_data_bytes,
+    palettise_image,
+    tiles_to_data,
+)
+
+SIZES = [(64, 48), (128, 96), (256, 192), (576, 480), (1152, 960)]
+SPRITE_SIZES = [(8, 8), (16, 16), (32, 24), (64, 48), (128, 96)]
+SHEET_TILES = [100, 1000, 4000]
+TILE_SIZES = [(6, 8), (16, 16)]
+MODES = [1, 2, 3, 4]
+REPEATS = 5
+MIN_RUN_TIME = 0.02  # seconds
+MIN_REGRESSION = 0.1  # milliseconds, ignoring smaller differences as noise
+
+GENERATORS = {
+    'masked': lambda image_data, mask_data: generate_draw_poke(image_data, mask_data),
+    'unmasked': lambda image_data, mask_data: generate_draw_poke(image_data, mask_data, masked=False),
+    'unmasked_push': lambda image_data, mask_data: generate_draw_push(image_data, mask_data),
+    'save_stack': lambda image_data, mask_data: generate_save_restore_stack(mask_data),
+    'save_ldi': lambda image_data, mask_data: generate_save_restore_ldi(mask_data),
+    'copy': lambda image_data, mask_data: generate_restore_copy(mask_data),
+    'clear_push': lambda image_data, mask_data: generate_clear_push(mask_data),
+    'rect_push': lambda image_data, mask_data: generate_clear_rect_push(len(mask_data[0]), len(mask_data)),
+}
+
+
+def synthetic_image(width, height, seed=0):
+    """Create a random image using SAM colours, some fully transparent"""
+    rng = random.Random(seed)
+    colours = [(*rgb, 255) for rgb in generate_sam_palette()[:15]] + [(0, 0, 0, 0)]
+    img = Image.new("RGBA", (width, height))
+    img.putdata([rng.choice(colours) for _ in range(width * height)])
+    return img
+
+
+def synthetic_png(width, height, seed=0):
+    """Create a random image as PNG file data"""
+    buf = io.BytesIO()
+    synthetic_image(width, height, seed).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def synthetic_sheet(mode, tile_width, tile_height, num_tiles):
+    """Create a sheet of CLUT index tiles for a screen mode, 100 tiles wide, with boxes for each tile"""
+    img = Image.new("P", (tile_width * 100, tile_height * ((num_tiles + 99) // 100)))
+    img.putdata([i % (1 << [1, 1, 2, 4][mode - 1]) for i in range(img.width * img.height)])
+    boxes = [((i % 100) * tile_width, (i // 100) * tile_height,
+              (i % 100 + 1) * tile_width, (i // 100 + 1) * tile_height) for i in range(num_tiles)]
+    return img, boxes
+
+
+def pack_tiles(args, img, boxes):
+    """Pack a sheet of tiles to data, consuming the tile data as it's generated"""
+    for _ in tiles_to_data(args, img, boxes):
+        pass
+
+
+def load_image(data):
+    """Open and decode an image from file data"""
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+
+
+def best_time(func, *args, repeats=REPEATS):
+    """Return the fastest of several timed runs, in milliseconds per call"""
+    # Repeat quick calls within each run, so each run takes at least MIN_RUN_TIME
+    start = time.perf_counter()
+    func(*args)
+    number = max(1, int(MIN_RUN_TIME / max(time.perf_counter() - start, 1e-6)))
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        times.append((time.perf_counter() - start) / number)
+    return min(times) * 1000
+
+
+def sprite_data(width, height, seed=0):
+    """Create random mode 4 sprite image and mask data, with some transparency"""
+    rng = random.Random(seed)
+    pixels = [rng.choice([1, 2, 3, 5, 8, 13, TRANSPARENT]) for _ in range(width * height)]
+    return [group_split(x, width // 2) for x in image_data_bytes(pixels)]
+
+
+def benchmark_cases():
+    """Yield the stage, case, work units and timed call for each benchmark"""
+    palette = generate_sam_palette()
+
+    for width, height in SIZES:
+        case, pixels = f"{width}x{height}", width * height
+        yield 'load', case, pixels, (load_image, synthetic_png(width, height))
+
+        img = synthetic_image(width, height)
+        yield 'palettise', case, pixels, (palettise_image, img, palette)
+
+        bkg_cols, img_pal = palettise_image(img, palette)
+        clut = sorted(x for _, x in img_pal.getcolors())
+        yield 'clutise', case, pixels, (clutise_image, img_pal, clut, bkg_cols)
+
+    for mode in MODES:
+        for tile_width, tile_height in TILE_SIZES:
+            for num_tiles in SHEET_TILES:
+                case = f"mode{mode}/{tile_width}x{tile_height}/{num_tiles}"
+                img, boxes = synthetic_sheet(mode, tile_width, tile_height, num_tiles)
+                args = argparse.Namespace(mode=mode, shift=1)
+                yield 'pack', case, num_tiles, (pack_tiles, args, img, boxes)
+
+    for name, generator in GENERATORS.items():
+        for width, height in SPRITE_SIZES:
+            image_data, mask_data = sprite_data(width, height)
+            yield f'generate_{name}', f"{width}x{height}", width * height // 2, (generator, image_data, mask_data)
+
+
+def run_benchmarks(stages=None, repeats=REPEATS):
+    """Run the benchmarks, printing a table of results and returning them by stage and case"""
+    results = {}
+    print(f"{'benchmark':<32} {'ms':>9} {'us/unit':>9}")
+
+    for stage, case, units, (func, *args) in benchmark_cases():
+        if stages and stage not in stages:
+            continue
+
+        ms = best_time(func, *args, repeats=repeats)
+        results[f"{stage}/{case}"] = ms
+        print(f"{stage + '/' + case:<32} {ms:>9.2f} {ms * 1000 / units:>9.3f}")
+
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """Return descriptions of the results slower than the baseline by more than the threshold"""
+    regressions = []
+    for key, ms in results.items():
+        base_ms = baseline.get(key)
+        if base_ms and ms > base_ms * (1 + threshold / 100) and ms - base_ms > MIN_REGRESSION:
+            regressions.append(f"{key}: {ms:.2f}ms vs {base_ms:.2f}ms baseline (+{(ms / base_ms - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tile2sam conversion stages.",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', help="write JSON results to file")
+    parser.add_argument('-b', '--baseline', help="JSON results to compare against")
+    parser.add_argument('-t', '--threshold', default=50.0, type=float, help="percentage slowdown counted as regression")
+    parser.add_argument('-r', '--repeats', default=REPEATS, type=int, help="timed runs of each benchmark, keeping the best")
+    parser.add_argument('-s', '--stage', action='append', help="only run the given stage (repeatable)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.stage, args.repeats)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                      f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            sys.exit("error: performance regressions:\n  " + "\n  ".join(regressions))
+        print(f"No regressions beyond {args.threshold:g}% against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
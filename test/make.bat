@@ -10,9 +10,19 @@ echo Extracting tiles
 ..\src\tile2sam\tile2sam.py --mode 1 --tiles 76 sprites_mono.png 12
 ..\src\tile2sam\tile2sam.py --clut sprites.pal --pal --tiles 0-240,241,242-251 tiles.png 6
 ..\src\tile2sam\tile2sam.py --mode 1 --tiles 192 tiles_mono.png 6
+..\src\tile2sam\tile2sam.py --clut sprites.pal --dedup --index -o tiles_dedup.bin tiles.png 6
+..\src\tile2sam\tile2sam.py --clut sprites.pal --scale 2 --pages --index -o tiles_pages.bin tiles.png 7x5
+..\src\tile2sam\tile2sam.py --clut sprites.pal --scale 2 --pages files --index -o tiles_split.bin tiles.png 7x5
+..\src\tile2sam\tile2sam.py --code masked,unmasked,save,copy,clear,rect --verify --tiles 24 -o sprites_code.asm sprites.png 12x12
+..\src\tile2sam\tile2sam.py --code masked,unmasked,save,copy,clear,rect --optimal-regs --search-order --verify --tiles 24 -o sprites_code_opt.asm sprites.png 12x12
+..\src\tile2sam\tile2sam.py --code masked,unmasked,save,copy,clear,rect --optimal-regs --search-order --timing-model display --verify --tiles 24 -o sprites_code_display.asm sprites.png 12x12
 ..\src\tile2sam\tile2sam.py --crop 512x384+32+48 --scale 0.5x0.5 --mode 2 mode2.png 256x192
 ..\src\tile2sam\tile2sam.py --crop 512x384+32+48 --scale 1.0x0.5 --mode 3 --pal mode3.png 512x192
 ..\src\tile2sam\tile2sam.py --crop 512x384+32+48 --scale 0.5 --pal mode4.png 256x192
+..\src\tile2sam\tile2sam.py --bands --clut sprites.pal --tiles 0-240,241,242-251 -o tiles_bands.bin tiles.png 6
+..\src\tile2sam\tile2sam.py --bands --crop 512x384+32+48 --scale 0.5x0.5 --mode 2 -o mode2_bands.bin mode2.png 256x192
+..\src\tile2sam\tile2sam.py --bands --crop 512x384+32+48 --scale 1.0x0.5 --mode 3 --pal -o mode3_bands.bin mode3.png 512x192
+..\src\tile2sam\tile2sam.py --bands --crop 512x384+32+48 --scale 0.5 --pal -o mode4_bands.bin mode4.png 256x192
 pyz80 mode2.asm >nul
 pyz80 mode3.asm >nul
 pyz80 mode4.asm >nul
@@ -30,16 +40,29 @@ fc /b sprites_mono.bin golden\sprites_mono.bin >nul || echo MISMATCH: sprites_mo
 fc /b tiles.bin golden\tiles.bin >nul || echo MISMATCH: tiles.bin
 fc /b tiles.pal golden\sprites.pal >nul || echo MISMATCH: tiles.pal
 fc /b tiles_mono.bin golden\tiles_mono.bin >nul || echo MISMATCH: tiles_mono.bin
+fc /b tiles_dedup.bin golden\tiles_dedup.bin >nul || echo MISMATCH: tiles_dedup.bin
+fc /b tiles_dedup.idx golden\tiles_dedup.idx >nul || echo MISMATCH: tiles_dedup.idx
 fc /b mode2.bin golden\mode2.bin >nul || echo MISMATCH: mode2.bin
 fc /b mode3.bin golden\mode3.bin >nul || echo MISMATCH: mode3.bin
 fc /b mode4.bin golden\mode4.bin >nul || echo MISMATCH: mode4.bin
 fc /b mode3.pal golden\mode3.pal >nul || echo MISMATCH: mode3.pal
 fc /b mode4.pal golden\mode4.pal >nul || echo MISMATCH: mode4.pal
+fc /b tiles_pages.bin golden\tiles_pages.bin >nul || echo MISMATCH: tiles_pages.bin
+fc /b tiles_pages.idx golden\tiles_pages.idx >nul || echo MISMATCH: tiles_pages.idx
+fc /b tiles_split_0.bin golden\tiles_split_0.bin >nul || echo MISMATCH: tiles_split_0.bin
+fc /b tiles_split_1.bin golden\tiles_split_1.bin >nul || echo MISMATCH: tiles_split_1.bin
+fc /b tiles_split.idx golden\tiles_pages.idx >nul || echo MISMATCH: tiles_split.idx
+fc /b tiles_bands.bin golden\tiles.bin >nul || echo MISMATCH: tiles_bands.bin
+fc /b mode2_bands.bin golden\mode2.bin >nul || echo MISMATCH: mode2_bands.bin
+fc /b mode3_bands.bin golden\mode3.bin >nul || echo MISMATCH: mode3_bands.bin
+fc /b mode4_bands.bin golden\mode4.bin >nul || echo MISMATCH: mode4_bands.bin
+fc /b mode3_bands.pal golden\mode3.pal >nul || echo MISMATCH: mode3_bands.pal
+fc /b mode4_bands.pal golden\mode4.pal >nul || echo MISMATCH: mode4_bands.pal
 
 goto end
 
 :clean
-	del /q *.bin *.pal *.idx *.dsk 2>nul
+	del /q *.bin *.pal *.idx *.dsk sprites_code*.asm 2>nul
 
 :end
 echo Done.